@@ -2,280 +2,2866 @@
 #
 # Project Oxford Command Line Interface
 # by Ivan R. Judson
-# 
+#
 
-import uuid
-import datetime
 import os
 import os.path
-import shutil
+import sys
+import glob
+import threading
+import time
+import re
+import io
+import collections
+import atexit
+import contextlib
+import bisect
+import socket
+import struct
+import errno
+import traceback
+import importlib
+import mmap
+
+# A module imported the first time one of its attributes is used, so a
+# command line only pays for the modules its command actually needs. The
+# first of names that imports is used, for modules that moved in Python 3.
+class LazyModule(object):
+
+    def __init__(self, *names):
+        self.names = names
+        self.module = None
+
+    # the module, or None when none of the names import
+    def find(self):
+        if self.module is None:
+            for name in self.names:
+                try:
+                    self.module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    pass
+        return self.module
+
+    def __getattr__(self, attr):
+        if self.find() is None:
+            raise ImportError('No module named %s' % self.names[0])
+        return getattr(self.module, attr)
+
+uuid = LazyModule('uuid')
+copy = LazyModule('copy')
+datetime = LazyModule('datetime')
+shutil = LazyModule('shutil')
+random = LazyModule('random')
+hashlib = LazyModule('hashlib')
+email_utils = LazyModule('email.utils')
+tempfile = LazyModule('tempfile')
+multiprocessing = LazyModule('multiprocessing')
+csv = LazyModule('csv')
+sqlite3 = LazyModule('sqlite3')
+subprocess = LazyModule('subprocess')
+
+# Python 2 or 3 names for urlparse and urlencode
+urlparse = LazyModule('urllib.parse', 'urlparse')
+urllib = LazyModule('urllib.parse', 'urllib')
+
+def urlencode(query):
+    return urllib.urlencode(query)
 
-# Python 2 or 3 import for urlparse
-try:
-    from urllib import parser as urlparse
-except ImportError:
-    import urlparse
+# Python 2 or 3 names for the mock api's and metrics' http servers
+BaseHTTPServer = LazyModule('http.server', 'BaseHTTPServer')
+SocketServer = LazyModule('socketserver', 'SocketServer')
 
-# json for serialization, from the standard library 
-import json
+# json for serialization, from the standard library, and ujson when it's
+# installed since it reads and writes json several times faster
+json = LazyModule('json')
+fastjson = LazyModule('ujson')
 # requests makes things much more sane than the standard library
 # http://docs.python-requests.org/en/latest/
-import requests
-# click provides the command line interpreter functionality
-# http://click.pocoo.org/4/
-import click
+requests = LazyModule('requests')
+# futures gives us a bounded thread pool for the batch commands
+# https://pypi.python.org/pypi/futures
+futures = LazyModule('concurrent.futures')
 
 # Global variables
 CONFIG_FILE=os.path.expanduser("~/.projectoxford.json")
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+CACHE_DIR=os.path.expanduser("~/.projectoxford/cache")
+MIRROR_DB=os.path.expanduser("~/.projectoxford/mirror.db")
+SOCKET_FILE=os.path.expanduser("~/.projectoxford/oxford.sock")
+OCR_INDEX=os.path.expanduser("~/.projectoxford/ocr.db")
+
+#
+# Forwarding to a running oxford serve daemon. This comes before click and
+# the commands are loaded, a forwarded command line needs neither.
+#
+
+# One frame of a forwarded command's conversation, its channel, length and
+# data. The daemon sends 'o' and 'e' for stdout and stderr, 'i' to ask for
+# more stdin and 'x' with the exit code, the client answers 'i' with 'd'.
+def send_frame(sock, channel, data):
+    sock.sendall(struct.pack('!cI', channel, len(data)) + data)
+
+def recv_frame(f):
+    header = f.read(5)
+    if len(header) < 5:
+        raise EOFError()
+    channel, size = struct.unpack('!cI', header)
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError()
+    return channel, data
+
+# the commands never forwarded, they run the daemon or their own servers
+LOCAL_COMMANDS = ['serve', 'mock', 'bench']
+
+# Run this command line on the daemon if one is listening, returning its exit
+# code, or None to run it here. Set OXFORD_NO_DAEMON to always run here.
+def forward(argv):
+    path = os.environ.get('OXFORD_SOCKET', SOCKET_FILE)
+    if os.environ.get('OXFORD_NO_DAEMON') or not os.path.exists(path):
+        return None
+    if set(argv) & set(LOCAL_COMMANDS):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        # a daemon that died and left its socket behind
+        sock.close()
+        return None
+    env = dict((name, value) for name, value in os.environ.items() if name.startswith('OXFORD_'))
+    sock.sendall(json.dumps({ 'argv' : argv, 'cwd' : os.getcwd(), 'env' : env, 'tty' : sys.stdin.isatty() }) + '\n')
+    f = sock.makefile('rb')
+    streams = { 'o' : sys.stdout, 'e' : sys.stderr }
+    try:
+        while True:
+            channel, data = recv_frame(f)
+            if channel == 'x':
+                return int(data)
+            if channel == 'i':
+                # whatever is there, up to what was asked for
+                send_frame(sock, 'd', os.read(sys.stdin.fileno(), int(data)))
+                continue
+            streams[channel].write(data)
+            streams[channel].flush()
+    except EOFError:
+        sys.stderr.write('The oxford daemon hung up.\n')
+        return 1
+    except IOError as e:
+        # our reader went away, e.g. head, hang up so the command stops too
+        if e.errno != errno.EPIPE:
+            raise
+        return 1
+    finally:
+        sock.close()
+
+if __name__ == '__main__':
+    code = forward(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+
+# click provides the command line interpreter functionality
+# http://click.pocoo.org/4/
+import click
+
+# A group whose subcommands are registered by the name of the function that
+# defines them, and only looked up once a command line or --help needs them
+class LazyGroup(click.Group):
+
+    def __init__(self, *args, **kwargs):
+        super(LazyGroup, self).__init__(*args, **kwargs)
+        self.lazy_commands = {}
+
+    def add_lazy_command(self, name, function_name):
+        self.lazy_commands[name] = function_name
+
+    def list_commands(self, ctx):
+        return sorted(set(self.commands) | set(self.lazy_commands))
+
+    def get_command(self, ctx, name):
+        if name not in self.commands and name in self.lazy_commands:
+            self.commands[name] = globals()[self.lazy_commands[name]]
+        return self.commands.get(name)
+
+# The forwarded command a thread is working for, in a daemon running each
+# command forwarded to it on a thread of its own, unset outside a daemon
+forwarded = threading.local()
+
+# a path from the command line, relative to where the command was run, the
+# client's working directory for a forwarded command
+def local_path(path):
+    command = getattr(forwarded, 'command', None)
+    return os.path.join(command.cwd, path) if command else path
+
+# fn, to run on another thread as part of the command this one works for
+def with_command(fn):
+    command = getattr(forwarded, 'command', None)
+    if command is None:
+        return fn
+
+    def run(*args, **kwargs):
+        previous = getattr(forwarded, 'command', None)
+        forwarded.command = command
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            forwarded.command = previous
+    return run
+
+# click's Path and File types, taking relative paths from where the command was run
+class LocalPath(click.Path):
+
+    def convert(self, value, param, ctx):
+        return click.Path.convert(self, local_path(value), param, ctx)
+
+class LocalFile(click.File):
+
+    def convert(self, value, param, ctx):
+        if value != '-':
+            value = local_path(value)
+        return click.File.convert(self, value, param, ctx)
+
+# Where each service lives under the oxford url
+SERVICES = {
+    'face' : 'face/v0',
+    'vision' : 'vision/v1',
+}
+
+# Requests per second allowed per api key for each service, unless the config
+# file has its own 'rates' or --rate is given
+RATES = {
+    'face' : 10.0,
+    'vision' : 10.0,
+}
 
 # Load API Key from config file
 def load_config(fname):
     if os.path.isfile(fname):
         with open(fname, 'r') as f:
-            return json.load(f)
+            config = json.load(f)
+        config.setdefault('apikeys', {})
+        # vision save-api-key used to save its key outside apikeys
+        if 'vision' in config:
+            config['apikeys'].setdefault('vision', config.pop('vision'))
+        return config
     else:
         return {'apikeys':{}}
 
 def save_config(fname, config):
      with open(fname, 'w') as f:
         json.dump(config, f)
-       
-# oxford is the command-line, it only has sub commands and two configuration options
+
+class OxfordError(click.ClickException):
+    """A request to Project Oxford could not be made."""
+
+# A token bucket shared by every request made with one api key to one service.
+# The rate halves each time the service answers 429 and creeps back up towards
+# the configured rate as requests succeed, so a batch settles at the highest
+# rate the subscription actually sustains.
+class RateLimiter(object):
+
+    def __init__(self, rate):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        # until when the last slow down holds everyone back
+        self.held_until = 0.0
+        self.lock = threading.Lock()
+
+    # take a token, returning how long to wait before it may be spent
+    def reserve(self):
+        if not self.max_rate:
+            return 0.0
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    # the service said slow down, hold everyone back for at least delay
+    # seconds. The rest of a burst sent before the first 429 came back is
+    # answered 429 too, so those that come while held back change nothing.
+    def throttled(self, delay):
+        if not self.max_rate:
+            return
+        with self.lock:
+            now = time.time()
+            if now < self.held_until:
+                return
+            self.held_until = now + delay
+            self.tokens = min(self.tokens, -delay * self.rate)
+            self.rate = max(self.max_rate / 64.0, self.rate / 2.0)
+
+    def succeeded(self):
+        if not self.max_rate:
+            return
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20.0)
+
+# the delay a 429 or 503 asked for, from Retry-After or the error message
+def retry_after(resp):
+    value = resp.headers.get('Retry-After')
+    if value:
+        if value.isdigit():
+            return float(value)
+        when = email_utils.parsedate_tz(value)
+        if when:
+            return max(0.0, email_utils.mktime_tz(when) - time.time())
+    match = re.search(r'in (\d+) seconds', resp.text or '')
+    if match:
+        return float(match.group(1))
+
+# POSTs that only compute an answer, or restart training, so sending one
+# twice does no harm. Other POSTs create things, e.g. a person, and are only
+# retried when the service certainly didn't act on them.
+IDEMPOTENT_POSTS = ('/detections', '/identifications', '/verifications', '/findsimilars',
+                    '/groupings', '/analyses', '/ocr', '/thumbnails', '/training')
+
+def idempotent(method, path):
+    return method != 'POST' or path.endswith(IDEMPOTENT_POSTS)
+
+# a connection error from before any of the request was sent: the name
+# didn't resolve, or the connection was refused, unreachable or timed out
+def unsent(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)
+    if type(reason).__name__ in ('NewConnectionError', 'ConnectTimeoutError'):
+        return True
+    cause = reason.args[-1] if getattr(reason, 'args', None) else reason
+    return (isinstance(cause, socket.gaierror) or
+            getattr(cause, 'errno', None) in (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH))
+
+# full jitter exponential backoff
+def backoff(attempt, base=0.5, cap=30.0):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+# A service's keys: the config file's "pools" can list several (key,
+# endpoint) pairs for each service, the endpoint defaulting to --oxford-url, e.g.
+#   "pools" : { "face" : [{ "key" : "..." }, { "key" : "...", "endpoint" : "https://..." }] }
+# and without one a service's pool is its api key at --oxford-url.
+
+# failures in a row that open a pool entry's circuit breaker, and the
+# seconds it stays open before one request is let through to try it
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 30.0
+
+# One key at one endpoint, with its own rate limiter, a count of its
+# requests in flight and a circuit breaker
+class PoolEntry(object):
+
+    def __init__(self, key, endpoint, rate):
+        self.key = key
+        self.endpoint = endpoint
+        self.limiter = RateLimiter(rate)
+        self.outstanding = 0
+        self.failures = 0
+        # when an open breaker may be tried again, 0 while it's closed
+        self.open_until = 0.0
+        self.trial = False
+        # until when a 429 asked this key to wait
+        self.held_until = 0.0
+
+    def available(self, now):
+        return not self.open_until or (now >= self.open_until and not self.trial)
+
+    # take a token, returning how long to wait before it may be spent
+    def reserve(self):
+        return max(self.limiter.reserve(), self.held_until - time.time())
+
+    # the service said slow down, hold this key's requests back for delay seconds
+    def hold(self, delay):
+        self.limiter.throttled(delay)
+        self.held_until = max(self.held_until, time.time() + delay)
+
+    def url(self, service, path):
+        return '%s/%s%s' % (self.endpoint, SERVICES[service], path)
+
+    def headers(self, headers=None):
+        headers = dict(headers or {})
+        headers['Ocp-Apim-Subscription-Key'] = self.key
+        return headers
+
+# Requests are spread over a pool's entries by least outstanding requests,
+# entries held back by a 429 last and ties going round robin. An entry's breaker opens after BREAKER_FAILURES
+# 5xx answers or lost connections in a row, when its key is refused (401,
+# 403, which is also how an exhausted quota is answered), or when a 429
+# asks for a wait longer than the cooldown. Entries with an open breaker get
+# no traffic while another entry is available; when none is, the one that
+# reopens first is used rather than stalling.
+class KeyPool(object):
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.turn = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            ready = [entry for entry in self.entries if entry.available(now)]
+            if ready:
+                start = self.turn % len(ready)
+                self.turn += 1
+                entry = min(ready[start:] + ready[:start], key=lambda entry: (entry.held_until > now, entry.outstanding))
+            else:
+                entry = min(self.entries, key=lambda entry: entry.open_until)
+            if entry.open_until:
+                entry.trial = True
+            entry.outstanding += 1
+            return entry
+
+    # hand an entry back with its response, or None when it got none
+    def release(self, entry, resp):
+        with self.lock:
+            now = time.time()
+            entry.outstanding -= 1
+            entry.trial = False
+            if resp is None or resp.status_code >= 500:
+                entry.failures += 1
+                if entry.failures >= BREAKER_FAILURES:
+                    entry.open_until = now + BREAKER_COOLDOWN
+            elif resp.status_code in (401, 403):
+                entry.open_until = now + BREAKER_COOLDOWN
+            elif resp.status_code == 429:
+                delay = retry_after(resp) or 0.0
+                if delay > BREAKER_COOLDOWN:
+                    entry.open_until = now + delay
+            else:
+                entry.failures = 0
+                entry.open_until = 0.0
+
+# The attempts at one request, the retry loop the thread and async engines
+# share: start() picks an entry and says how long to wait before sending on
+# it, finish() hands the entry back with what came of the attempt and says
+# how long to wait before the next, or None when the response is the answer.
+class Attempts(object):
+
+    def __init__(self, client, method, service, path, call=None):
+        self.client = client
+        self.pool = client.pool(service)
+        self.safe = idempotent(method, path)
+        self.call = call
+        self.count = 0
+        self.entry = None
+
+    def start(self):
+        self.entry = self.pool.acquire()
+        return self.entry, self.entry.reserve()
+
+    # the attempt's response, or the connection error that stopped it
+    def finish(self, resp, error=None):
+        entry, self.entry = self.entry, None
+        self.pool.release(entry, resp)
+        delay = self.client.retry_delay(entry, resp, error, self.count, self.safe)
+        if delay is not None:
+            self.count = self.client.retried(self.count, self.call)
+        return delay
+
+    # the attempt failed in a way that isn't retried, nothing to do when
+    # it already finished
+    def abandon(self):
+        if self.entry is not None:
+            entry, self.entry = self.entry, None
+            self.pool.release(entry, None)
+
+# The phases a traced call's time is split into:
+# - wait, for the rate limiter and between retries
+# - connect, dns and tcp for a new connection
+# - tls, the handshake of a new https connection
+# - upload, sending the request line, headers and body
+# - server, from the last byte sent to the response headers
+# - download, reading the response body
+# - decode, parsing the response json
+TRACE_PHASES = ['wait', 'connect', 'tls', 'upload', 'server', 'download', 'decode']
+
+# upper bounds, in seconds, of the latency histogram's buckets
+TRACE_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+# a call's endpoint, its path with the ids taken out, e.g.
+# GET face/v0/persongroups/{id}/persons
+def endpoint_name(method, service, path):
+    parts = path.split('/')
+    for i in range(1, len(parts)):
+        if parts[i - 1] in ('persongroups', 'persons', 'faces'):
+            parts[i] = '{id}'
+    return '%s %s%s' % (method, SERVICES[service], '/'.join(parts))
+
+# One traced call, its retries included, and the spans of its phases
+class TraceCall(object):
+
+    def __init__(self, method, service, path, size):
+        self.method = method
+        self.service = service
+        self.path = path
+        self.size = size
+        self.received = 0
+        self.status = None
+        self.retries = 0
+        self.error = None
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.end = None
+        self.spans = []
+
+    @property
+    def endpoint(self):
+        return endpoint_name(self.method, self.service, self.path)
+
+    def span(self, phase, start, end):
+        self.spans.append((phase, start, end))
+
+    def phases(self):
+        totals = dict((phase, 0.0) for phase in TRACE_PHASES)
+        for phase, start, end in self.spans:
+            totals[phase] += end - start
+        return totals
+
+    def record(self):
+        return {
+            'endpoint' : self.endpoint,
+            'path' : self.path,
+            'start' : self.start,
+            'duration' : (self.end or self.start) - self.start,
+            'status' : self.status,
+            'retries' : self.retries,
+            'error' : self.error,
+            'bytes_up' : self.size,
+            'bytes_down' : self.received,
+            'thread' : self.thread,
+            'phases' : self.phases(),
+        }
+
+# Records every http call a command makes, set up by oxford --trace or
+# --trace-file. The client begins a call and ends it, the connections in
+# between add their connect, tls, upload and server spans to the call their
+# thread is making.
+class Tracer(object):
+
+    def __init__(self, summary, path=None, format='jsonl'):
+        self.summary = summary
+        self.path = path
+        self.format = format
+        self.calls = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def begin(self, call):
+        self.local.call = call
+
+    def end(self, call):
+        self.local.call = None
+        with self.lock:
+            self.calls.append(call)
+
+    # time a phase of the call this thread is making, if any
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.span(name, start, time.time())
+
+    def span(self, name, start, end):
+        call = getattr(self.local, 'call', None)
+        if call is not None:
+            call.span(name, start, end)
+
+    def close(self):
+        if self.path:
+            with open(self.path, 'w') as f:
+                if self.format == 'chrome':
+                    json.dump({ 'traceEvents' : self.chrome_events() }, f)
+                else:
+                    for call in self.calls:
+                        f.write(dumps(call.record()) + '\n')
+        if self.summary and self.calls:
+            self.report(click.get_text_stream('stderr'))
+
+    # complete events for chrome://tracing or https://ui.perfetto.dev, a call
+    # and its phases nested under it on the thread that made it
+    def chrome_events(self):
+        pid = os.getpid()
+        events = []
+        for call in self.calls:
+            record = call.record()
+            args = dict((key, record[key]) for key in ('path', 'status', 'retries', 'error', 'bytes_up', 'bytes_down'))
+            events.append({ 'name' : call.endpoint, 'cat' : call.service, 'ph' : 'X', 'pid' : pid, 'tid' : call.thread,
+                            'ts' : call.start * 1e6, 'dur' : record['duration'] * 1e6, 'args' : args })
+            for phase, start, end in call.spans:
+                events.append({ 'name' : phase, 'cat' : 'phase', 'ph' : 'X', 'pid' : pid, 'tid' : call.thread,
+                                'ts' : start * 1e6, 'dur' : (end - start) * 1e6 })
+        return events
+
+    # mean phase times for each endpoint, and a histogram of call latency
+    def report(self, out):
+        endpoints = collections.OrderedDict()
+        for call in sorted(self.calls, key=lambda call: call.endpoint):
+            endpoints.setdefault(call.endpoint, []).append(call)
+        out.write('%-44s %6s %6s %7s %8s' % ('endpoint', 'calls', 'errors', 'retries', 'KB up') +
+                  ''.join(' %8s' % phase for phase in TRACE_PHASES) + ' %8s %8s\n' % ('p50', 'p95'))
+        for endpoint, calls in endpoints.items():
+            durations = sorted(call.end - call.start for call in calls)
+            errors = sum(1 for call in calls if call.error or call.status >= 400)
+            phases = [call.phases() for call in calls]
+            out.write('%-44s %6d %6d %7d %8.1f' % (endpoint, len(calls), errors, sum(call.retries for call in calls),
+                                                  sum(call.size for call in calls) / 1024.0) +
+                      ''.join(' %8.1f' % (1000 * sum(p[phase] for p in phases) / len(calls)) for phase in TRACE_PHASES) +
+                      ' %8.1f %8.1f\n' % (1000 * percentile(durations, 50), 1000 * percentile(durations, 95)))
+        out.write('(phases are mean milliseconds per call)\n\n')
+        counts = [0] * (len(TRACE_BUCKETS) + 1)
+        for call in self.calls:
+            counts[bisect.bisect_left(TRACE_BUCKETS, call.end - call.start)] += 1
+        widest = max(counts)
+        labels = ['<= %gms' % (bound * 1000) for bound in TRACE_BUCKETS] + ['> %gms' % (TRACE_BUCKETS[-1] * 1000)]
+        used = [i for i, count in enumerate(counts) if count]
+        for label, count in zip(labels, counts)[used[0]:used[-1] + 1]:
+            out.write('%12s %6d %s\n' % (label, count, '#' * int(round(40.0 * count / widest))))
+
+tracer = None
+
+# the value below which a percentage of the sorted values fall
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+# Counters, gauges and histograms of the calls a command makes, served in the
+# Prometheus text format by oxford --metrics-port while the command runs
+class Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.in_flight = collections.Counter()
+        self.retries = collections.Counter()
+        self.cache = collections.Counter()
+        self.uploaded = collections.Counter()
+        self.downloaded = collections.Counter()
+        self.buckets = collections.defaultdict(lambda: [0] * (len(TRACE_BUCKETS) + 1))
+        self.seconds = collections.Counter()
+        self.server = None
+
+    def begin(self, call):
+        with self.lock:
+            self.in_flight[call.service] += 1
+
+    def end(self, call):
+        endpoint = call.endpoint
+        with self.lock:
+            self.in_flight[call.service] -= 1
+            self.requests[(endpoint, str(call.status or 'error'))] += 1
+            self.retries[endpoint] += call.retries
+            # every attempt sends the body again
+            self.uploaded[endpoint] += call.size * (1 + call.retries)
+            self.downloaded[endpoint] += call.received
+            self.buckets[endpoint][bisect.bisect_left(TRACE_BUCKETS, call.end - call.start)] += 1
+            self.seconds[endpoint] += call.end - call.start
+
+    # a lookup in the result cache, hit or not
+    def cache_lookup(self, endpoint, hit):
+        with self.lock:
+            self.cache[(endpoint, 'hit' if hit else 'miss')] += 1
+
+    # the metrics in the Prometheus text exposition format
+    def exposition(self):
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, metric_labels(labels), repr(float(value))))
+
+        with self.lock:
+            family('oxford_requests_total', 'counter', 'Calls to Project Oxford by endpoint and final status.',
+                   [((('endpoint', endpoint), ('status', status)), count) for (endpoint, status), count in sorted(self.requests.items())])
+            family('oxford_requests_in_flight', 'gauge', 'Calls to Project Oxford waiting on an answer.',
+                   [((('service', service),), self.in_flight[service]) for service in sorted(SERVICES)])
+            family('oxford_retries_total', 'counter', 'Calls retried after a 429, 5xx or connection error.',
+                   [((('endpoint', endpoint),), count) for endpoint, count in sorted(self.retries.items())])
+            family('oxford_cache_lookups_total', 'counter', 'Result cache lookups by endpoint and result.',
+                   [((('endpoint', endpoint), ('result', result)), count) for (endpoint, result), count in sorted(self.cache.items())])
+            family('oxford_uploaded_bytes_total', 'counter', 'Request body bytes sent.',
+                   [((('endpoint', endpoint),), count) for endpoint, count in sorted(self.uploaded.items())])
+            family('oxford_downloaded_bytes_total', 'counter', 'Response body bytes received.',
+                   [((('endpoint', endpoint),), count) for endpoint, count in sorted(self.downloaded.items())])
+            lines.append('# HELP oxford_request_duration_seconds Call latency, retries and waits included.')
+            lines.append('# TYPE oxford_request_duration_seconds histogram')
+            for endpoint, counts in sorted(self.buckets.items()):
+                total = 0
+                for bound, count in zip(TRACE_BUCKETS + ['+Inf'], counts):
+                    total += count
+                    lines.append('oxford_request_duration_seconds_bucket%s %d' % (metric_labels((('endpoint', endpoint), ('le', str(bound)))), total))
+                lines.append('oxford_request_duration_seconds_sum%s %r' % (metric_labels((('endpoint', endpoint),)), self.seconds[endpoint]))
+                lines.append('oxford_request_duration_seconds_count%s %d' % (metric_labels((('endpoint', endpoint),)), total))
+        return '\n'.join(lines) + '\n'
+
+    # serve /metrics on a background thread
+    def start(self, host, port):
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.exposition()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        try:
+            self.server = Server((host, port), Handler)
+        except socket.error as e:
+            raise click.UsageError('Can\'t serve metrics on %s:%d, %s.' % (host, port, e))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+metrics = None
+
+# a Prometheus label set, e.g. {endpoint="POST face/v0/detections",status="200"}
+def metric_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in labels)
+
+# begin and end a call for the tracer and metrics, whichever are on
+def begin_call(method, service, path, size):
+    if not tracer and not metrics:
+        return None
+    call = TraceCall(method, service, path, size)
+    if tracer:
+        tracer.begin(call)
+    if metrics:
+        metrics.begin(call)
+    return call
+
+def end_call(call):
+    call.end = time.time()
+    if tracer:
+        tracer.end(call)
+    if metrics:
+        metrics.end(call)
+
+# a urllib3 connection class that adds its connect, upload and server
+# spans to the tracer's current call
+traced_connections = {}
+
+def traced_connection(base):
+    if base not in traced_connections:
+        https = issubclass(base, requests.packages.urllib3.connection.HTTPSConnection)
+
+        class TracedConnection(base):
+
+            # dns and tcp, connect() opens the socket with this
+            def _new_conn(self):
+                with tracer.phase('connect'):
+                    sock = base._new_conn(self)
+                self.opened = time.time()
+                return sock
+
+            # what https connect() does after opening the socket is the tls handshake
+            def connect(self):
+                self.opened = None
+                base.connect(self)
+                if https and self.opened is not None:
+                    tracer.span('tls', self.opened, time.time())
+
+            def request(self, *args, **kwargs):
+                # connect now, httplib would otherwise do it inside the upload
+                if self.sock is None:
+                    self.connect()
+                with tracer.phase('upload'):
+                    base.request(self, *args, **kwargs)
+
+            def getresponse(self, *args, **kwargs):
+                with tracer.phase('server'):
+                    return base.getresponse(self, *args, **kwargs)
+
+        traced_connections[base] = TracedConnection
+    return traced_connections[base]
+
+# an adapter class whose connection pools make traced connections, made
+# when first needed so requests is only imported by commands that use it
+traced_adapters = []
+
+def traced_adapter():
+    if not traced_adapters:
+        class TracedAdapter(requests.adapters.HTTPAdapter):
+
+            def get_connection(self, url, proxies=None):
+                pool = super(TracedAdapter, self).get_connection(url, proxies)
+                if not issubclass(pool.ConnectionCls, tuple(traced_connections.values())):
+                    pool.ConnectionCls = traced_connection(pool.ConnectionCls)
+                return pool
+
+        traced_adapters.append(TracedAdapter)
+    return traced_adapters[0]
+
+# the number of bytes in a request body, a file or a string
+def payload_size(data):
+    if data is None:
+        return 0
+    if hasattr(data, 'fileno'):
+        return os.fstat(data.fileno()).st_size
+    return len(data)
+
+# The transport shared by every subcommand: one pooled, keep-alive session,
+# so commands making several calls reuse their connections, and a pool of
+# keys per service, each key at each endpoint with its own rate limiter.
+# Requests answered 429 or 5xx, or that could not connect, are retried with
+# backoff, each attempt on whichever key the pool picks.
+class OxfordClient(object):
+
+    def __init__(self, oxford_url, apikeys, pool_size=10, connect_timeout=5.0, read_timeout=60.0,
+                 rates=None, max_retries=5, pools=None):
+        self.oxford_url = oxford_url.rstrip('/')
+        self.apikeys = apikeys
+        self.pools = pools or {}
+        self.timeout = (connect_timeout, read_timeout)
+        self.rates = dict(RATES, **(rates or {}))
+        self.max_retries = max_retries
+        self.entries = {}
+        self.key_pools = {}
+        self.entries_lock = threading.Lock()
+        self.session = requests.Session()
+        self.pool_size = pool_size
+        self.mount(len(SERVICES))
+        if latency_log:
+            self.session.hooks['response'].append(latency_log.hook)
+
+    # an adapter keeping connections to as many hosts as the pools' endpoints
+    # are on, with fewer urllib3 would close one host's connections to open
+    # another's on every call
+    def mount(self, hosts):
+        adapter = (traced_adapter() if tracer else requests.adapters.HTTPAdapter)(pool_connections=hosts, pool_maxsize=self.pool_size)
+        # kept with the adapter, which every view of the client shares
+        adapter.hosts = hosts
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # this client with a command's own api keys, sharing its connections,
+    # rate limiters and breakers with every other command a daemon runs
+    def with_keys(self, apikeys, pools):
+        client = copy.copy(self)
+        client.apikeys = apikeys
+        client.pools = pools
+        return client
+
+    def url(self, service, path):
+        return '%s/%s%s' % (self.oxford_url, SERVICES[service], path)
+
+    # the service's pool of keys, an entry shared by every pool with its key and endpoint
+    def pool(self, service):
+        keys = [(entry.get('key'), entry.get('endpoint', self.oxford_url).rstrip('/'))
+                for entry in self.pools.get(service) or [{ 'key' : self.apikeys.get(service) }]]
+        if not all(key for key, endpoint in keys):
+            raise OxfordError('No %s API key, use save-api-key or --apikey.' % service)
+        with self.entries_lock:
+            for key in keys:
+                if (service,) + key not in self.entries:
+                    self.entries[(service,) + key] = PoolEntry(key[0], key[1], self.rates[service])
+                    hosts = len(set(urlparse.urlparse(endpoint)[:2] for _, _, endpoint in self.entries))
+                    if hosts > self.session.get_adapter(self.oxford_url).hosts:
+                        self.mount(hosts)
+            if (service, tuple(keys)) not in self.key_pools:
+                self.key_pools[(service, tuple(keys))] = KeyPool([self.entries[(service,) + key] for key in keys])
+            return self.key_pools[(service, tuple(keys))]
+
+    # How long to wait before retrying an attempt, or None to hand its
+    # response back. Lost connections are retried after a backoff when the
+    # request is idempotent or certainly wasn't sent, and raised once retries
+    # run out. 5xx answers to idempotent requests are retried after
+    # Retry-After or a backoff. A 429 holds its entry back for the wait and
+    # is retried at once, on another entry when one is ready, or on the same
+    # one once its wait is over.
+    def retry_delay(self, entry, resp, error, attempt, safe=True):
+        if error is not None:
+            if attempt >= self.max_retries or not (safe or unsent(error)):
+                raise OxfordError(str(error))
+            return backoff(attempt)
+        if resp.status_code != 429 and (resp.status_code < 500 or not safe) or attempt >= self.max_retries:
+            if resp.status_code < 400:
+                entry.limiter.succeeded()
+            return None
+        delay = retry_after(resp)
+        if delay is None:
+            delay = backoff(attempt)
+        if resp.status_code == 429:
+            entry.hold(delay)
+            return 0.0
+        return delay
+
+    def request(self, method, service, path, params=None, data=None, headers=None, stream=False):
+        # a missing key is an error before the call is traced
+        self.pool(service)
+        call = begin_call(method, service, path, payload_size(data))
+        if not call:
+            return self.send(method, service, path, params, data, headers, stream)
+        try:
+            resp = self.send(method, service, path, params, data, headers, stream, call)
+            call.status = resp.status_code
+            if not stream:
+                call.received = len(resp.content)
+            resp.trace = call
+            return resp
+        except OxfordError as e:
+            call.error = str(e)
+            raise
+        finally:
+            end_call(call)
+
+    # make a request, retrying it as need be, with an optional trace of the call
+    def send(self, method, service, path, params, data, headers, stream, call=None):
+        attempts = Attempts(self, method, service, path, call)
+        while True:
+            if hasattr(data, 'seek'):
+                data.seek(0)
+            entry, wait = attempts.start()
+            try:
+                self.sleep(wait, call)
+                resp = self.session.request(method, entry.url(service, path), params=params, data=data,
+                                            headers=entry.headers(headers), timeout=self.timeout, stream=stream)
+            except requests.ConnectionError as e:
+                delay = attempts.finish(None, e)
+            except requests.RequestException as e:
+                attempts.abandon()
+                raise OxfordError(str(e))
+            else:
+                if call and not stream and call.spans and call.spans[-1][0] == 'server':
+                    # requests read the body after the server span ended
+                    call.span('download', call.spans[-1][2], time.time())
+                delay = attempts.finish(resp)
+                if delay is None:
+                    return resp
+                resp.close()
+            self.sleep(delay, call)
+
+    def sleep(self, delay, call=None):
+        if delay:
+            start = time.time()
+            time.sleep(delay)
+            if call:
+                call.span('wait', start, time.time())
+
+    def retried(self, attempt, call=None):
+        if call:
+            call.retries += 1
+        return attempt + 1
+
+    def get(self, service, path, **kwargs):
+        return self.request('GET', service, path, **kwargs)
+
+    def post(self, service, path, **kwargs):
+        return self.request('POST', service, path, **kwargs)
+
+    def put(self, service, path, **kwargs):
+        return self.request('PUT', service, path, **kwargs)
+
+    def patch(self, service, path, **kwargs):
+        return self.request('PATCH', service, path, **kwargs)
+
+    def delete(self, service, path, **kwargs):
+        return self.request('DELETE', service, path, **kwargs)
+
+# An on-disk cache of successful results, keyed by the image (its content hash,
+# or its url), the endpoint and the query parameters. Each entry is a file
+# holding its creation time on the first line and the raw response body after
+# it; the file's mtime is bumped on every hit so eviction drops the least
+# recently used entries once the cache grows past max_size bytes.
+class ResultCache(object):
+
+    def __init__(self, path, ttl, max_size):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+
+    def key(self, url, params, image_path):
+        digest = hashlib.sha256()
+        digest.update(url)
+        for name, value in sorted((params or {}).items()):
+            digest.update('&%s=%s' % (name, str(value).lower()))
+        if type(image_path) is urlparse.ParseResult:
+            digest.update('#' + image_path.geturl())
+        else:
+            digest.update('#')
+            for chunk in iter(lambda: image_path.read(65536), ''):
+                digest.update(chunk)
+            image_path.seek(0)
+        return digest.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def entries(self):
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                fname = os.path.join(root, name)
+                try:
+                    stat = os.stat(fname)
+                except OSError:
+                    continue
+                yield fname, stat
+
+    def get(self, key):
+        fname = self.filename(key)
+        try:
+            with open(fname, 'rb') as f:
+                created = float(f.readline())
+                if time.time() - created > self.ttl:
+                    return None
+                body = f.read()
+            os.utime(fname, None)
+            return body
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, body):
+        fname = self.filename(key)
+        try:
+            if not os.path.isdir(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            tmp = '%s.%s.tmp' % (fname, uuid.uuid4().hex)
+            with open(tmp, 'wb') as f:
+                f.write('%f\n' % time.time())
+                f.write(body)
+            os.rename(tmp, fname)
+        except (IOError, OSError):
+            return
+        with self.lock:
+            if self.size is None:
+                self.size = sum(stat.st_size for _, stat in self.entries())
+            else:
+                self.size += len(body)
+            if self.size > self.max_size:
+                self.evict()
+
+    # drop least recently used entries until the cache is back under 90% of max_size
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda entry: entry[1].st_mtime)
+        self.size = sum(stat.st_size for _, stat in entries)
+        for fname, stat in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(fname)
+                self.size -= stat.st_size
+            except OSError:
+                pass
+
+    def stats(self):
+        now = time.time()
+        entries = list(self.entries())
+        return {
+            'path' : self.path,
+            'entries' : len(entries),
+            'bytes' : sum(stat.st_size for _, stat in entries),
+            'max_bytes' : self.max_size,
+            'ttl' : self.ttl,
+            'lru_age' : now - min([stat.st_mtime for _, stat in entries] or [now]),
+        }
+
+    def purge(self, expired_only=False):
+        removed = 0
+        for fname, stat in self.entries():
+            if expired_only:
+                try:
+                    with open(fname, 'rb') as f:
+                        if time.time() - float(f.readline()) <= self.ttl:
+                            continue
+                except (IOError, ValueError):
+                    pass
+            try:
+                os.remove(fname)
+                removed += 1
+            except OSError:
+                pass
+        self.size = None
+        return removed
+
+# a response built from a body we already have
+def make_response(status_code, body, headers=None, reason=None):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.reason = reason
+    resp.headers.update(headers or {})
+    resp.encoding = 'utf-8'
+    resp._content = body
+    return resp
+
+# a response served from the result cache
+def cached_response(body):
+    resp = make_response(200, body, {'Content-Type' : 'application/json; charset=utf-8'}, 'OK')
+    resp.from_cache = True
+    return resp
+
+# headers for a json request body
+JSON_HEADERS = { 'Content-Type' : 'application/json' }
+
+# the error message from a failed response
+def error_message(resp):
+    try:
+        body = resp.json()
+    except ValueError:
+        return '%d %s' % (resp.status_code, resp.reason)
+    if 'error' in body:
+        body = body['error']
+    return body.get('message', '%d %s' % (resp.status_code, resp.reason))
+
+# how results are printed, set by oxford --output
+# - json pretty prints each result, batches print one compact record a line
+# - ndjson prints one compact record a line, a list gives a line per item
+# - raw passes response bodies through without parsing them
+# - csv flattens records to dotted columns, headed by the first record, with
+#   a row per result when a batch record holds a list of them
+OUTPUT_FORMATS = ['json', 'ndjson', 'raw', 'csv']
+OUTPUT = { 'format' : 'json', 'csv' : None, 'dropped' : set() }
+
+# one writer at a time, batches print from many threads
+output_lock = threading.Lock()
+
+# compact dumps, always with json: ujson rounds floats however high its
+# double_precision goes, and results must print as the service sent them
+def dumps(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+# loads, with ujson when it's installed, parsing floats exactly as json does
+def loads(text):
+    if fastjson.find() is not None:
+        return fastjson.loads(text, precise_float=True)
+    return json.loads(text)
+
+# a response body kept as it came, for --output raw
+class RawJSON(str):
+    pass
+
+# the parsed json of a response, timed when the call was traced
+def response_json(resp):
+    call = getattr(resp, 'trace', None)
+    start = time.time()
+    data = loads(resp.content)
+    if call:
+        call.span('decode', start, time.time())
+    return data
+
+# the body of a successful response, parsed unless the output is raw
+def response_body(resp):
+    if OUTPUT['format'] == 'raw':
+        return RawJSON(resp.content)
+    return response_json(resp)
+
+# write some text to stdout, one writer at a time
+def write_out(text):
+    with output_lock:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+# a record as a single line of json, raw bodies are spliced in as they are
+def json_line(record):
+    raw = [(key, value) for key, value in record.items() if isinstance(value, RawJSON)]
+    if not raw:
+        return dumps(record)
+    line = dumps(dict((key, value) for key, value in record.items() if not isinstance(value, RawJSON)))
+    # a newline in a json document can only be whitespace
+    spliced = ','.join('%s:%s' % (dumps(key), value.replace('\r', '').replace('\n', '')) for key, value in raw)
+    if line == '{}':
+        return '{' + spliced + '}'
+    return line[:-1] + ',' + spliced + '}'
+
+# flatten nested json to a row of dotted columns, e.g. faces.0.faceId
+def flatten(data, prefix='', row=None):
+    if row is None:
+        row = {}
+    if isinstance(data, RawJSON):
+        data = loads(data)
+    if isinstance(data, dict):
+        for key, value in data.items():
+            flatten(value, '%s%s.' % (prefix, key), row)
+    elif isinstance(data, list):
+        for i, value in enumerate(data):
+            flatten(value, '%s%d.' % (prefix, i), row)
+    else:
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        row[prefix[:-1] or 'value'] = data
+    return row
+
+# the csv rows of a batch record: a row for each result in a list of them,
+# e.g. each face of detect-batch, with the image and status repeated, so
+# images with more faces than the first don't need more columns
+def csv_rows(record):
+    for key, value in record.items():
+        if isinstance(value, RawJSON):
+            value = loads(value)
+        if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+            rest = flatten(dict((name, other) for name, other in record.items() if name != key))
+            return [flatten(item, key + '.', dict(rest)) for item in value]
+    return [flatten(record)]
+
+# write csv rows, the columns are fixed by the first rows written and any
+# that turn up later are dropped, with a warning the first time each does
+def write_csv(rows):
+    with output_lock:
+        if OUTPUT['csv'] is None:
+            columns = []
+            for row in rows:
+                columns.extend(sorted(column for column in row if column not in columns))
+            OUTPUT['csv'] = csv.DictWriter(sys.stdout, columns, extrasaction='ignore')
+            OUTPUT['csv'].writeheader()
+            OUTPUT['dropped'] = set()
+        writer = OUTPUT['csv']
+        dropped = set(column for row in rows for column in row) - set(writer.fieldnames) - OUTPUT['dropped']
+        if dropped:
+            OUTPUT['dropped'].update(dropped)
+            click.echo('Dropped csv columns missing from the header: %s' % ', '.join(sorted(dropped)), err=True)
+        writer.writerows(rows)
+        sys.stdout.flush()
+
+# print a result in the chosen output format
+def echo_json(data):
+    if OUTPUT['format'] == 'json':
+        print json.dumps(data, sort_keys=True, indent=2, separators=(',', ': '))
+    elif OUTPUT['format'] == 'csv':
+        write_csv([flatten(item) for item in (data if isinstance(data, list) else [data])])
+    elif OUTPUT['format'] == 'ndjson' and isinstance(data, list):
+        write_out(''.join(json_line(item) + '\n' for item in data))
+    else:
+        write_out(json_line(data) + '\n')
+
+# print a single result of a batch as soon as it's ready
+def echo_line(record):
+    if OUTPUT['format'] == 'csv':
+        write_csv(csv_rows(record))
+    else:
+        write_out(json_line(record) + '\n')
+
+# print the json of a successful response, or the error message
+def echo_response(resp):
+    if resp.status_code != 200:
+        print error_message(resp)
+    elif OUTPUT['format'] == 'raw':
+        body = resp.content
+        write_out(body if body.endswith('\n') else body + '\n')
+    else:
+        echo_json(response_json(resp))
+
+# print the error message of a response, if it failed
+def echo_error(resp):
+    if resp.status_code != 200:
+        print error_message(resp)
+
+# oxford is the command-line, it only has sub commands and configuration options
 # - a url to find the Project Oxford REST API
-@click.group()
+# - the connection pool size and timeouts of the shared client
+# - the request rate and retries of the shared client
+# - the result cache
+# - the local PersonGroup mirror
+# - how results are printed
+# - tracing the http calls
+# - serving metrics
+@click.group(cls=LazyGroup)
 @click.option('--oxford-url', default='https://api.projectoxford.ai/', help='The url to the project oxford api.')
+@click.option('--pool-size', default=10, type=click.IntRange(1, None), help='Connections kept open to each host, shared by the services on it.')
+@click.option('--connect-timeout', default=5.0, help='Seconds to wait for a connection.')
+@click.option('--read-timeout', default=60.0, help='Seconds to wait for a response.')
+@click.option('--rate', default=None, type=float, help='Requests per second per api key (0 for no limit).')
+@click.option('--max-retries', default=5, help='Retries for requests answered 429 or 5xx.')
+@click.option('--cache/--no-cache', default=True, help='Answer detect, analyze and ocr from the local result cache.')
+@click.option('--cache-dir', default=CACHE_DIR, type=LocalPath(file_okay=False), help='Where the result cache lives.')
+@click.option('--cache-ttl', default=12 * 3600, help='Seconds a cached result stays fresh (faceIds expire after 24 hours).')
+@click.option('--cache-size', default=256, help='Megabytes kept in the result cache before evicting.')
+@click.option('--mirror-db', default=MIRROR_DB, type=LocalPath(dir_okay=False), help='Where the local PersonGroup mirror lives.')
+@click.option('--output', default='json', type=click.Choice(OUTPUT_FORMATS), help='Print results as pretty json, one json record a line, the raw response bodies, or csv.')
+@click.option('--trace', is_flag=True, help='Time the phases of every http call, printing a summary to stderr (or set OXFORD_TRACE=1).')
+@click.option('--trace-file', default=None, type=LocalPath(dir_okay=False), help='Write every traced call to this file.')
+@click.option('--trace-format', default='jsonl', type=click.Choice(['jsonl', 'chrome']), help='Write the trace file as json lines, or as chrome trace events.')
+@click.option('--metrics-port', default=None, type=int, help='Serve Prometheus metrics at http://HOST:PORT/metrics while the command runs.')
+@click.option('--metrics-host', default='127.0.0.1', help='The address to serve metrics on.')
 @click.pass_context
-def oxford(ctx, oxford_url):
+def oxford(ctx, oxford_url, pool_size, connect_timeout, read_timeout, rate, max_retries, cache, cache_dir, cache_ttl, cache_size, mirror_db, output, trace, trace_file, trace_format, metrics_port, metrics_host):
+    global tracer, metrics
+    # a daemon serves the metrics of every command it runs, from the
+    # --metrics-port it was started with
+    if warm is not None and metrics_port is not None:
+        raise click.UsageError('The oxford daemon is serving the metrics, give --metrics-port to oxford serve.')
+    traced = Tracer(trace, trace_file, trace_format) if trace or trace_file else None
+    if traced:
+        ctx.call_on_close(traced.close)
+    # a daemon's commands each have a tracer of their own
+    if getattr(forwarded, 'command', None):
+        forwarded.command.tracer = traced
+    else:
+        tracer = traced
+    if warm is None:
+        metrics = Metrics() if metrics_port is not None else None
+        if metrics:
+            metrics.start(metrics_host, metrics_port)
+            ctx.call_on_close(metrics.stop)
+    OUTPUT.update(format=output, csv=None)
     ctx.obj = load_config(CONFIG_FILE)
     ctx.obj['oxford_url'] = oxford_url
+    rates = ctx.obj.get('rates', {})
+    if rate is not None:
+        rates = dict((service, rate) for service in SERVICES)
+    settings = (oxford_url, pool_size, connect_timeout, read_timeout, tuple(sorted(rates.items())), max_retries, bool(traced))
+    client = shared('client', settings, lambda: OxfordClient(oxford_url, ctx.obj['apikeys'], pool_size=pool_size,
+                                                             connect_timeout=connect_timeout, read_timeout=read_timeout,
+                                                             rates=rates, max_retries=max_retries))
+    # the keys may have changed since a daemon made the client, and another
+    # command it's running may have keys of its own
+    ctx.obj['client'] = client.with_keys(ctx.obj['apikeys'], ctx.obj.setdefault('pools', {}))
+    ctx.obj['cache'] = shared('cache', (cache_dir, cache_ttl, cache_size),
+                              lambda: ResultCache(cache_dir, cache_ttl, cache_size * 1024 * 1024))
+    ctx.obj['use_cache'] = cache
+    ctx.obj['mirror_db'] = mirror_db
 
 #
 # Face sub command: https://www.projectoxford.ai/doc/face/overview
 #
-@click.group()
+@click.group(cls=LazyGroup)
 @click.option('--apikey', envvar='OXFORD_FACE_APIKEY', default=None, help='Your API Key from http://https://dev.projectoxford.ai/.')
 @click.pass_context
 def face(ctx, apikey):
     if apikey:
         ctx.obj['apikeys']['face'] = apikey
-    ctx.obj['oxford_url'] += 'face/v0'
+        ctx.obj['pools'].pop('face', None)
+
+# save a service's api key, or add it to the service's pool of keys
+def save_api_key(service, apikey, pool, endpoint):
+    config = load_config(CONFIG_FILE)
+    if pool or endpoint:
+        entry = { 'key' : apikey }
+        if endpoint:
+            entry['endpoint'] = endpoint
+        entries = config.setdefault('pools', {}).setdefault(service, [])
+        entries[:] = [e for e in entries if (e['key'], e.get('endpoint')) != (apikey, endpoint)] + [entry]
+    else:
+        config['apikeys'][service] = apikey
+    save_config(CONFIG_FILE, config)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--pool', is_flag=True, help='Add the key to the pool of face keys requests are spread over.')
+@click.option('--endpoint', default=None, help='The endpoint the pooled key is for, instead of --oxford-url.')
 @click.argument('apikey')
 @click.pass_context
-def face_api_key(ctx, apikey):
-    config = load_config(CONFIG_FILE)
-    config['apikeys']['face'] = apikey
-    save_config(CONFIG_FILE, config)
-    
+def face_api_key(ctx, pool, endpoint, apikey):
+    save_api_key('face', apikey, pool, endpoint)
+
 # a function to resolve if the input is an image file or a url
 def resolve_input(ctx, param, value):
     # this will catch both http and https
     if value.startswith('http'):
         return urlparse.urlparse(value)
+    elif value == '-':
+        # spool stdin to disk so it can be hashed, sized and resent like any file
+        spool = tempfile.TemporaryFile()
+        shutil.copyfileobj(click.get_binary_stream('stdin'), spool)
+        spool.seek(0)
+        return spool
     else:
-        return click.utils.open_file(value)
-        
-# detect a face in an image         
-@click.command(context_settings=CONTEXT_SETTINGS)
-@click.option('--analyzesfacelandmarks/--no-analyzesfacelandmarks', default=True, help='Optional parameter to get face landmarks.')
-@click.option('--analyzesage/--no-analyzesage', default=True, help='Optional parameter to get age.')
-@click.option('--analyzesgender/--no-analyzesgender', default=True, help='Optional parameter to get gender.')
-@click.option('--analyzesheadpose/--no-analyzesheadpose', default=True, help='Optional parameter to get values of head-pose.')
-@click.argument('image_path', callback=resolve_input)
-@click.pass_context
-def detect(ctx, analyzesfacelandmarks, analyzesage, analyzesgender, analyzesheadpose, image_path):
-    """Detect faces in an image provided on the command line."""
-    detection_path = '/detections'
-    params = {
+        return click.utils.open_file(local_path(value), 'rb')
+
+# the query parameters for a face detection
+def detection_params(analyzesfacelandmarks, analyzesage, analyzesgender, analyzesheadpose):
+    return {
     'analyzesFaceLandmarks' : str(analyzesfacelandmarks).lower(),
     'analyzesAge' : str(analyzesage).lower(),
     'analyzesGender' : str(analyzesgender).lower(),
     'analyzesHeadPose' : str(analyzesheadpose).lower()
     }
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    face_detect_url = ctx.obj['oxford_url'] + detection_path
+
+# build the request body for an image file or url, setting the content type.
+# Files are handed to requests as they are, it sizes them with fstat for the
+# Content-Length and streams them in blocks, so an upload never holds more
+# than a block of the image in memory.
+def image_payload(image_path, headers, url_key='url'):
     if type(image_path) is file:
         headers['Content-type'] = 'application/octet-stream'
-        payload = image_path.read()
+        return image_path
     if type(image_path) is urlparse.ParseResult:
         headers['Content-type'] = 'application/json'
-        payload = json.dumps({ 'url' : image_path.geturl() })
-    try:
-        resp = requests.post(face_detect_url, params=params, data=payload, headers=headers)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
+        return json.dumps({ url_key : image_path.geturl() })
+
+# Shrink an image so its longest side is at most max_dimension pixels and it
+# encodes to at most max_bytes, returning the jpeg and the scale it was resized
+# by, or None when the original is already small enough. This runs in the
+# Shrinker's worker processes, so it takes a path (or a file when run inline).
+def shrink_image(image_path, max_dimension, max_bytes):
+    # Pillow is optional, only --max-dimension and --max-bytes need it
+    # https://python-pillow.github.io/
+    from PIL import Image
+    image = Image.open(image_path)
+    width, height = image.size
+    scale = 1.0
+    if max_dimension and max(width, height) > max_dimension:
+        scale = float(max_dimension) / max(width, height)
+    if isinstance(image_path, basestring):
+        size = os.path.getsize(image_path)
+    else:
+        size = os.fstat(image_path.fileno()).st_size
+    if scale == 1.0 and (not max_bytes or size <= max_bytes):
+        return None
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    quality = 90
+    while True:
+        resized = image
+        if scale < 1.0:
+            resized = image.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.ANTIALIAS)
+        out = io.BytesIO()
+        resized.save(out, 'JPEG', quality=quality)
+        if not max_bytes or out.tell() <= max_bytes or max(resized.size) <= 64:
+            return out.getvalue(), scale
+        # trade quality first, then resolution
+        if quality > 60:
+            quality -= 15
         else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
-                
-# find similar faces
-@click.command(context_settings=CONTEXT_SETTINGS)
-def find_similar():
-    click.echo('Finds similar-looking faces of a specified face from a list of candidate faces.')
+            scale *= 0.75
+
+# Pre-shrinks local images before upload, on a pool of worker processes so a
+# batch uses every core. With no processes it shrinks inline.
+class Shrinker(object):
+
+    def __init__(self, max_dimension=None, max_bytes=None, processes=0):
+        try:
+            import PIL
+        except ImportError:
+            raise click.UsageError('--max-dimension and --max-bytes need Pillow, pip install Pillow.')
+        self.max_dimension = max_dimension
+        self.max_bytes = max_bytes
+        self.pool = None
+        if processes:
+            self.pool = futures.ProcessPoolExecutor(max_workers=processes)
+            # start the workers now, before the batch starts its threads
+            self.pool.submit(int).result()
+
+    # the shrink settings, so cached results for different settings don't mix
+    def params(self):
+        return { 'maxDimension' : self.max_dimension, 'maxBytes' : self.max_bytes }
 
+    # images Pillow can't read are sent as they are, for the service to judge
+    def shrink(self, image_path):
+        try:
+            if self.pool and isinstance(image_path.name, basestring):
+                return self.pool.submit(shrink_image, image_path.name, self.max_dimension, self.max_bytes).result()
+            return shrink_image(image_path, self.max_dimension, self.max_bytes)
+        except IOError:
+            return None
+        finally:
+            image_path.seek(0)
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+
+# a shrinker for the --max-dimension/--max-bytes options, or None when neither is given
+def make_shrinker(max_dimension, max_bytes, processes=0):
+    if max_dimension or max_bytes:
+        return Shrinker(max_dimension, max_bytes, processes)
+
+# scale face rectangles and landmarks from a shrunk image back to the original
+def rescale(data, scale):
+    if isinstance(data, list):
+        return [rescale(item, scale) for item in data]
+    if not isinstance(data, dict):
+        return data
+    result = {}
+    for name, value in data.items():
+        if name == 'faceRectangle':
+            result[name] = dict((side, int(round(x / scale))) for side, x in value.items())
+        elif name == 'faceLandmarks':
+            result[name] = dict((landmark, { 'x' : point['x'] / scale, 'y' : point['y'] / scale })
+                                for landmark, point in value.items())
+        elif name == 'metadata' and 'width' in value:
+            result[name] = dict(value, width=int(round(value['width'] / scale)), height=int(round(value['height'] / scale)))
+        else:
+            result[name] = rescale(value, scale)
+    return result
+
+# post an image to an endpoint, answering from the result cache when we can,
+# and shrinking local images first when given a shrinker
+def post_image(ctx, service, path, image_path, params=None, url_key='url', shrink=None):
+    client = ctx.obj['client']
+    key = None
+    if ctx.obj['use_cache']:
+        key_params = dict(params or {}, **(shrink.params() if shrink else {}))
+        key = ctx.obj['cache'].key(client.url(service, path), key_params, image_path)
+        body = ctx.obj['cache'].get(key)
+        if metrics:
+            metrics.cache_lookup(endpoint_name('POST', service, path), body is not None)
+        if body is not None:
+            return cached_response(body)
+    headers = {}
+    shrunk = None
+    if shrink and type(image_path) is file:
+        shrunk = shrink.shrink(image_path)
+    if shrunk:
+        payload, scale = shrunk
+        headers['Content-type'] = 'application/octet-stream'
+    else:
+        payload, scale = image_payload(image_path, headers, url_key), 1.0
+    resp = client.post(service, path, params=params, data=payload, headers=headers)
+    if resp.status_code == 200 and scale != 1.0:
+        resp = make_response(200, json.dumps(rescale(resp.json(), scale)), resp.headers, resp.reason)
+    if key and resp.status_code == 200:
+        ctx.obj['cache'].put(key, resp.content)
+    return resp
+
+# detect a face in an image
 @click.command(context_settings=CONTEXT_SETTINGS)
-def find_groups():
-    click.echo('Divides candidate faces into groups based on face similarity.')
+@click.option('--analyzesfacelandmarks/--no-analyzesfacelandmarks', default=True, help='Optional parameter to get face landmarks.')
+@click.option('--analyzesage/--no-analyzesage', default=True, help='Optional parameter to get age.')
+@click.option('--analyzesgender/--no-analyzesgender', default=True, help='Optional parameter to get gender.')
+@click.option('--analyzesheadpose/--no-analyzesheadpose', default=True, help='Optional parameter to get values of head-pose.')
+@click.option('--max-dimension', default=None, type=int, help='Shrink local images to at most this many pixels a side before upload.')
+@click.option('--max-bytes', default=None, type=int, help='Re-encode local images to at most this many bytes before upload.')
+@click.argument('image_path', callback=resolve_input)
+@click.pass_context
+def detect(ctx, analyzesfacelandmarks, analyzesage, analyzesgender, analyzesheadpose, max_dimension, max_bytes, image_path):
+    """Detect faces in an image provided on the command line."""
+    params = detection_params(analyzesfacelandmarks, analyzesage, analyzesgender, analyzesheadpose)
+    shrink = make_shrinker(max_dimension, max_bytes)
+    resp = post_image(ctx, 'face', '/detections', image_path, params=params, shrink=shrink)
+    echo_response(resp)
+
+# image types picked up when a batch is given a directory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff')
+
+def is_image(path):
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+# read a newline-delimited manifest of image paths or urls, skipping blanks and comments
+def read_manifest(f):
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+# expand batch sources (directories, globs, manifests or '-' for stdin) into
+# images, named relative to where the command was run as the source is
+def expand_sources(sources):
+    for source in sources:
+        path = local_path(source)
+        # what local_path put in front of the source, taken off what's found
+        added = len(path) - len(source)
+        if source == '-':
+            for image in read_manifest(sys.stdin):
+                yield image
+        elif source.startswith('http'):
+            yield source
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if is_image(name):
+                        yield os.path.join(root, name)[added:]
+        elif glob.has_magic(source):
+            for found in sorted(glob.glob(path)):
+                if os.path.isfile(found):
+                    yield found[added:]
+        elif os.path.isfile(path) and not is_image(source):
+            with open(path, 'r') as f:
+                for image in read_manifest(f):
+                    yield image
+        else:
+            yield source
+
+# run work(image) over every image with at most concurrency requests in flight,
+# handing each (image, result) to done() on this thread as soon as it finishes
+def run_batch(images, work, done, concurrency):
+    work = with_command(work)
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+        for image in images:
+            pending[executor.submit(work, image)] = image
+            if len(pending) >= concurrency * 2:
+                finished, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in finished:
+                    done(pending.pop(future), future.result())
+        for future in futures.as_completed(pending):
+            done(pending[future], future.result())
+
+# post one image of a batch, given its path or url
+def post_batch_image(ctx, image, service, path, params=None, url_key='url', shrink=None):
+    image_path = resolve_input(ctx, None, image)
+    try:
+        return post_image(ctx, service, path, image_path, params=params, url_key=url_key, shrink=shrink)
+    finally:
+        if type(image_path) is file:
+            image_path.close()
+
+# An event loop engine for batches of urls. Their request bodies are a few
+# bytes of json, so the work is all waiting on the network and one tornado
+# IOLoop can keep thousands of requests in flight, bounded by a semaphore.
+# Local files in the same batch are posted by the threaded client. Python 2
+# has no asyncio, tornado gives us the same coroutines (and runs on asyncio
+# under Python 3).
+class AsyncEngine(object):
+
+    def __init__(self, ctx, concurrency):
+        try:
+            # tornado is optional, only --engine async needs it
+            # http://www.tornadoweb.org/
+            from tornado import gen, httpclient, ioloop, locks
+        except ImportError:
+            raise click.UsageError('--engine async needs tornado, pip install tornado.')
+        self.gen = gen
+        self.httpclient = httpclient
+        self.ioloop = ioloop
+        self.locks = locks
+        self.ctx = ctx
+        self.client = ctx.obj['client']
+        self.concurrency = concurrency
+
+    # run a batch to completion on a fresh loop, start(item) giving a future
+    # of each item's result and done(item, result, error) called as it finishes
+    def run(self, items, start, done):
+        gen = self.gen
+        slots = self.locks.Semaphore(self.concurrency)
+        self.http = self.httpclient.AsyncHTTPClient(force_instance=True, max_clients=self.concurrency)
+        self.executor = futures.ThreadPoolExecutor(max_workers=min(self.concurrency, 32))
+
+        @gen.coroutine
+        def one(item):
+            result, error = None, None
+            try:
+                result = yield start(item)
+            except Exception as e:
+                error = e
+            slots.release()
+            done(item, result, error)
+
+        @gen.coroutine
+        def run():
+            for item in items:
+                yield slots.acquire()
+                one(item)
+            # every slot back means every item has finished
+            for _ in range(self.concurrency):
+                yield slots.acquire()
+
+        loop = self.ioloop.IOLoop(make_current=False)
+        try:
+            loop.run_sync(run)
+        finally:
+            self.http.close()
+            loop.close()
+            self.executor.shutdown()
 
+    # post every image, urls on the loop and local files on threads
+    def post_images(self, images, service, path, done, params=None, url_key='url', shrink=None):
+        def start(image):
+            if image.startswith('http'):
+                return self.fetch(service, path, urlparse.urlparse(image), params, url_key)
+            return self.executor.submit(with_command(post_batch_image), self.ctx, image, service, path, params, url_key, shrink)
+
+        self.run(images, start, done)
+
+    # post one url with the client's cache, rate limiter and retries
+    @property
+    def fetch(self):
+        gen = self.gen
+        client = self.client
+        cache = self.ctx.obj['cache'] if self.ctx.obj['use_cache'] else None
+
+        @gen.coroutine
+        def fetch(service, path, image_path, params, url_key):
+            url = client.url(service, path)
+            key = None
+            if cache:
+                key = cache.key(url, params, image_path)
+                body = cache.get(key)
+                if metrics:
+                    metrics.cache_lookup(endpoint_name('POST', service, path), body is not None)
+                if body is not None:
+                    raise gen.Return(cached_response(body))
+            resp = yield self.send(service, path, params, json.dumps({ url_key : image_path.geturl() }))
+            if key and resp.status_code == 200:
+                cache.put(key, resp.content)
+            raise gen.Return(resp)
+        return fetch
+
+    # make one thumbnail of a SharedImage, a url's on the loop streaming the
+    # response to a file, a local file's on a thread with make_thumbnail
+    @property
+    def thumbnail(self):
+        gen = self.gen
+
+        @gen.coroutine
+        def thumbnail(image, source, params, path):
+            if not image.startswith('http'):
+                result = yield self.executor.submit(with_command(make_thumbnail), self.client, source, params, path)
+                raise gen.Return(result)
+            f = thumbnail_file(path)
+            try:
+                with f:
+                    resp = yield self.send('vision', '/thumbnails', params, source.data, sink=f)
+                    written = f.tell()
+                if resp.status_code == 200:
+                    os.rename(f.name, path)
+            except Exception:
+                os.unlink(f.name)
+                raise
+            if resp.status_code != 200:
+                os.unlink(f.name)
+                raise gen.Return((resp.status_code, error_message(resp), 0))
+            raise gen.Return((resp.status_code, None, written))
+        return thumbnail
+
+    # post a json payload with the client's rate limiter and retries, the body
+    # of the response streamed to the file sink when there is one
+    @property
+    def send(self):
+        gen = self.gen
+        client = self.client
+
+        @gen.coroutine
+        def send(service, path, params, payload, sink=None):
+            query = '?' + urlencode(params) if params else ''
+            # a missing key is an error before the call is traced
+            client.pool(service)
+            # tornado doesn't expose its connections, a call's time on the
+            # wire is all put down to the server
+            call = begin_call('POST', service, path, len(payload))
+            attempts = Attempts(client, 'POST', service, path, call)
+            try:
+                while True:
+                    entry, wait = attempts.start()
+                    if sink:
+                        sink.seek(0)
+                        sink.truncate()
+                    yield self.sleep(wait, call)
+                    start = time.time()
+                    result = yield self.http.fetch(entry.url(service, path) + query, method='POST', body=payload,
+                                                   headers=entry.headers({'Content-type' : 'application/json'}),
+                                                   streaming_callback=sink.write if sink else None,
+                                                   connect_timeout=client.timeout[0], request_timeout=client.timeout[1],
+                                                   raise_error=False)
+                    if call:
+                        call.span('server', start, time.time())
+                    if result.code == 599:
+                        # tornado's code for a request that never got a response
+                        delay = attempts.finish(None, result.error)
+                    else:
+                        if latency_log:
+                            latency_log.record(result.request_time)
+                        body = result.body
+                        if sink:
+                            # only an error's body is wanted back, for its message
+                            sink.flush()
+                            sink.seek(0)
+                            body = sink.read() if result.code != 200 else ''
+                        resp = make_response(result.code, body, dict(result.headers), result.reason)
+                        delay = attempts.finish(resp)
+                        if delay is None:
+                            break
+                    yield self.sleep(delay, call)
+                if sink:
+                    sink.seek(0, os.SEEK_END)
+                if call:
+                    call.status, call.received = resp.status_code, sink.tell() if sink else len(resp.content)
+                    resp.trace = call
+            except Exception as e:
+                if call:
+                    call.error = str(e)
+                raise
+            finally:
+                # whatever stopped it, an attempt gives its entry back and
+                # the call is over
+                attempts.abandon()
+                if call:
+                    end_call(call)
+            raise gen.Return(resp)
+        return send
+
+    # sleep on the loop, putting the time down to the call's wait phase
+    @property
+    def sleep(self):
+        gen = self.gen
+
+        @gen.coroutine
+        def sleep(delay, call):
+            if delay:
+                start = time.time()
+                yield gen.sleep(delay)
+                if call:
+                    call.span('wait', start, time.time())
+        return sleep
+
+# post every image to an endpoint with the thread or async engine, handing
+# each image with its response, or the error it raised, to done() as it finishes
+def post_images(ctx, images, service, path, done, params=None, url_key='url', concurrency=8, engine='thread', shrink=None):
+    if engine == 'async':
+        return AsyncEngine(ctx, concurrency).post_images(images, service, path, done, params=params, url_key=url_key, shrink=shrink)
+
+    def work(image):
+        try:
+            return post_batch_image(ctx, image, service, path, params=params, url_key=url_key, shrink=shrink), None
+        except Exception as e:
+            return None, e
+
+    run_batch(images, work, lambda image, result: done(image, *result), concurrency)
+
+# the json result line for one image of a batch
+def batch_record(image, resp, error, name):
+    if error is not None:
+        return { 'image' : image, 'error' : str(error) }
+    if resp.status_code == 200:
+        return { 'image' : image, 'status' : resp.status_code, name : response_body(resp) }
+    return { 'image' : image, 'status' : resp.status_code, 'error' : error_message(resp) }
+
+# Batch jobs: each image's progress through a batch (pending, done or
+# failed, with the result line it printed) in a SQLite journal, so a batch
+# that dies can pick up where it stopped, and deterministic sharding so
+# machines can split a corpus between them without talking to each other.
+class Journal(object):
+
+    SCHEMA = """
+    create table if not exists jobs (
+        command text, image text, status text, result text, updatedAt real,
+        primary key (command, image));
+    create index if not exists jobs_by_status on jobs (command, status);
+    """
+
+    def __init__(self, fname, command):
+        directory = os.path.dirname(fname)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # results can finish on other threads, e.g. recognize's identify calls
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+        self.command = command
+        self.lock = threading.Lock()
+        self.committed = time.time()
+
+    # an image's status and result line, or None before it has run
+    def entry(self, image):
+        with self.lock:
+            return self.db.execute('select status, result from jobs where command = ? and image = ?',
+                                   (self.command, image)).fetchone()
+
+    # a commit every so often, a batch that dies keeps most of its progress
+    def record(self, image, status, result=None):
+        with self.lock:
+            self.db.execute('insert or replace into jobs values (?, ?, ?, ?, ?)',
+                            (self.command, image, status, result, time.time()))
+            if time.time() - self.committed > JOURNAL_COMMIT_INTERVAL:
+                self.db.commit()
+                self.committed = time.time()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+# the most seconds of job progress held in a transaction
+JOURNAL_COMMIT_INTERVAL = 1.0
+
+# a --shard given as i/N
+def parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise click.BadParameter('use i/N, e.g. 0/4')
+    if not 0 <= index < count:
+        raise click.BadParameter('use i/N with 0 <= i < N')
+    return index, count
+
+# the same image lands in the same shard on every machine
+def in_shard(image, shard):
+    if isinstance(image, unicode):
+        image = image.encode('utf-8')
+    index, count = shard
+    return int(hashlib.md5(image).hexdigest(), 16) % count == index
+
+# The journal and shard of one batch command. images() filters the batch
+# down to this shard and, resuming, to the images still to do, replaying
+# the result lines of those it skips, so a resumed batch prints the same
+# lines as one that never stopped. finished() journals each result line.
+class BatchJob(object):
+
+    def __init__(self, ctx, journal, resume, retry_failed, shard):
+        if (resume or retry_failed) and not journal:
+            raise click.UsageError('--resume and --retry-failed need a --journal.')
+        self.journal = Journal(journal, ctx.info_name) if journal else None
+        self.shard = shard
+        # the images that aren't run again, pending ones never finished so always are
+        if retry_failed:
+            self.skip = ('done',)
+        elif resume:
+            self.skip = ('done', 'failed')
+        else:
+            self.skip = ()
+
+    def images(self, images):
+        for image in images:
+            if self.shard and not in_shard(image, self.shard):
+                continue
+            if self.journal:
+                entry = self.journal.entry(image)
+                if entry and entry[0] in self.skip:
+                    echo_line(loads(entry[1]))
+                    continue
+                self.journal.record(image, 'pending')
+            yield image
+
+    # failed defaults to whether the result line is an error
+    def finished(self, image, record, failed=None):
+        if not self.journal:
+            return
+        if failed is None:
+            failed = 'error' in record
+        self.journal.record(image, 'failed' if failed else 'done', json_line(record))
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+
+# detect faces in many images, one json result per line
 @click.command(context_settings=CONTEXT_SETTINGS)
-@click.option('--maxnumofcandidatesreturned', default=1, help='Optional. Maximum number of the returned person candidates of each query. Valid range is 1-5. If not set, only the top 1 candidate will be returned.')
-@click.option('--persongroupid', default=str(uuid.uuid4()), help='Target person group\'s ID')
-@click.argument('faceid')
+@click.option('--analyzesfacelandmarks/--no-analyzesfacelandmarks', default=True, help='Optional parameter to get face landmarks.')
+@click.option('--analyzesage/--no-analyzesage', default=True, help='Optional parameter to get age.')
+@click.option('--analyzesgender/--no-analyzesgender', default=True, help='Optional parameter to get gender.')
+@click.option('--analyzesheadpose/--no-analyzesheadpose', default=True, help='Optional parameter to get values of head-pose.')
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight.')
+@click.option('--engine', default='thread', type=click.Choice(['thread', 'async']), help='Run requests on a thread pool, or on an event loop (needs tornado).')
+@click.option('--max-dimension', default=None, type=int, help='Shrink local images to at most this many pixels a side before upload.')
+@click.option('--max-bytes', default=None, type=int, help='Re-encode local images to at most this many bytes before upload.')
+@click.option('--store', default=None, type=LocalPath(file_okay=False), help='Also save the results as NumPy arrays in this directory, for oxford report (needs numpy).')
+@click.option('--journal', default=None, type=LocalPath(dir_okay=False), help='Record the progress of each image in this SQLite file.')
+@click.option('--resume', is_flag=True, help='Skip the images the journal has done or failed.')
+@click.option('--retry-failed', is_flag=True, help='Skip the images the journal has done, run the failed ones again.')
+@click.option('--shard', default=None, callback=parse_shard, help='Only run the images in shard i of N, e.g. 0/4.')
+@click.argument('sources', nargs=-1, required=True)
 @click.pass_context
-def identify(ctx, maxnumofcandidatesreturned, persongroupid, faceid):
-    params = dict()
-    identify_path = '/identifications'
-    headers = {
-    'Content-Type' : 'application/json',
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    identify_url = ctx.obj['oxford_url'] + identify_path
+def detect_batch(ctx, analyzesfacelandmarks, analyzesage, analyzesgender, analyzesheadpose, concurrency, engine, max_dimension, max_bytes, store, journal, resume, retry_failed, shard, sources):
+    """Detect faces in a directory, glob or manifest of images ('-' reads the manifest from stdin)."""
+    params = detection_params(analyzesfacelandmarks, analyzesage, analyzesgender, analyzesheadpose)
+    job = BatchJob(ctx, journal, resume, retry_failed, shard)
+    store = open_store(store, 'faces')
+    shrink = make_shrinker(max_dimension, max_bytes, processes=multiprocessing.cpu_count())
+
+    def done(image, resp, error):
+        record = batch_record(image, resp, error, 'faces')
+        if store:
+            store.add(record)
+        job.finished(image, record)
+        echo_line(record)
+
+    try:
+        post_images(ctx, job.images(expand_sources(sources)), 'face', '/detections', done, params=params,
+                    concurrency=concurrency, engine=engine, shrink=shrink)
+    finally:
+        if shrink:
+            shrink.close()
+        if store:
+            store.close()
+        job.close()
+
+# the most faceIds one identify call takes
+IDENTIFY_BATCH = 10
+
+# every faceId in some json, e.g. detect or detect-batch output
+def collect_faceids(data, faceids):
+    if isinstance(data, list):
+        for item in data:
+            collect_faceids(item, faceids)
+    elif isinstance(data, dict):
+        for name, value in data.items():
+            if name == 'faceId':
+                faceids.append(value)
+            else:
+                collect_faceids(value, faceids)
+    return faceids
+
+# the json in some text, either one document or one per line; lines that
+# aren't json come back as plain strings
+def read_documents(f):
+    text = f.read()
+    try:
+        return [json.loads(text)]
+    except ValueError:
+        pass
+    documents = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            documents.append(json.loads(line))
+        except ValueError:
+            documents.append(line)
+    return documents
+
+# read faceIds from detect's json, detect-batch's json lines, or one faceId a line
+def read_faceids(f):
+    faceids = []
+    for document in read_documents(f):
+        if isinstance(document, basestring):
+            faceids.append(document)
+        else:
+            collect_faceids(document, faceids)
+    return faceids
+
+# split a list into lists of at most size items
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+# one identify call, returning its results or its error
+def identify_batch(client, faceids, persongroupid, max_candidates):
     payload = json.dumps({
-        'subscription-key': ctx.obj['apikey'],
-        'faceIds' : [faceid],
+        'faceIds' : faceids,
         'personGroupId' : persongroupid,
-        'maxNumOfCandidatesReturned' : maxnumofcandidatesreturned,
+        'maxNumOfCandidatesReturned' : max_candidates,
         })
     try:
-        resp = requests.post(identify_url, params=params, data=payload, headers=headers)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
+        resp = client.post('face', '/identifications', data=payload, headers=JSON_HEADERS)
+    except OxfordError as e:
+        return None, str(e)
+    if resp.status_code != 200:
+        return None, error_message(resp)
+    return resp.json(), None
+
+# Identify faceIds against a PersonGroup, packing them into full identify
+# calls sent concurrently. Returns the results in the order of the faceIds
+# and the errors of any calls that failed.
+def identify_faces(client, faceids, persongroupid, max_candidates, concurrency=8):
+    unique = list(collections.OrderedDict.fromkeys(faceids))
+    found = {}
+    errors = []
+
+    def work(batch):
+        return identify_batch(client, batch, persongroupid, max_candidates)
+
+    def done(batch, result):
+        results, error = result
+        if error:
+            errors.append(error)
+        for item in results or []:
+            found[item['faceId']] = item
+
+    run_batch(chunks(unique, IDENTIFY_BATCH), work, done, concurrency)
+    return [found[faceid] for faceid in faceids if faceid in found], errors
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--maxnumofcandidatesreturned', default=1, help='Optional. Maximum number of the returned person candidates of each query. Valid range is 1-5. If not set, only the top 1 candidate will be returned.')
+@click.option('--persongroupid', default=lambda: str(uuid.uuid4()), help='Target person group\'s ID')
+@click.option('--faceids-file', type=LocalFile('r'), default=None, help='Read faceIds, or detect output, from this file (- for stdin).')
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight.')
+@click.argument('faceids', nargs=-1)
+@click.pass_context
+def identify(ctx, maxnumofcandidatesreturned, persongroupid, faceids_file, concurrency, faceids):
+    """Identify faceIds given as arguments, in a file, or piped in from detect."""
+    faceids = list(faceids)
+    if faceids_file is None and not faceids and not sys.stdin.isatty():
+        faceids_file = click.get_text_stream('stdin')
+    if faceids_file is not None:
+        faceids.extend(read_faceids(faceids_file))
+    if not faceids:
+        raise click.UsageError('No faceIds to identify.')
+    results, errors = identify_faces(ctx.obj['client'], faceids, persongroupid,
+                                     maxnumofcandidatesreturned, concurrency)
+    for error in errors:
+        print error
+    if results:
+        echo_json(results)
+
+# the most candidate faceIds one findsimilars or groupings call takes
+SIMILAR_BATCH = 100
+GROUPING_BATCH = 100
+
+# every face with landmarks in some json, e.g. detect or detect-batch output
+def collect_faces(data, faces):
+    if isinstance(data, list):
+        for item in data:
+            collect_faces(item, faces)
+    elif isinstance(data, dict):
+        if 'faceId' in data and data.get('faceLandmarks'):
+            faces.append(data)
         else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+            for value in data.values():
+                collect_faces(value, faces)
+    return faces
+
+# read the faces, with their landmarks, from detect's json or detect-batch's json lines
+def read_faces(f):
+    faces = []
+    for document in read_documents(f):
+        collect_faces(document, faces)
+    return faces
+
+# post json to an endpoint, returning the response's json or raising its error
+def post_json(client, service, path, body):
+    resp = client.post(service, path, data=json.dumps(body), headers=JSON_HEADERS)
+    if resp.status_code != 200:
+        raise OxfordError(error_message(resp))
+    return resp.json()
+
+# find faces similar to faceid among the candidates, splitting the candidates
+# into calls of SIMILAR_BATCH sent concurrently, best matches first
+def find_similar_faces(client, faceid, candidates, concurrency=8):
+    similar = []
+
+    def work(batch):
+        try:
+            return post_json(client, 'face', '/findsimilars', { 'faceId' : faceid, 'faceIds' : batch }), None
+        except OxfordError as e:
+            return None, e
+
+    def done(batch, result):
+        if result[1]:
+            raise result[1]
+        similar.extend(result[0])
+
+    run_batch(chunks(list(collections.OrderedDict.fromkeys(candidates)), SIMILAR_BATCH), work, done, concurrency)
+    return sorted(similar, key=lambda face: -face['confidence'])
+
+# Group faces by similarity. Past GROUPING_BATCH faces the faces are grouped
+# in concurrent chunks, then one representative of each chunk's groups (and
+# each messy face) is grouped again, and groups whose representatives land
+# together are merged.
+def group_faces(client, faceids, concurrency=8):
+    faceids = list(collections.OrderedDict.fromkeys(faceids))
+    if len(faceids) <= GROUPING_BATCH:
+        result = post_json(client, 'face', '/groupings', { 'faceIds' : faceids })
+        return result['groups'], result['messyGroup']
+    clusters = []
+
+    def work(batch):
+        try:
+            return post_json(client, 'face', '/groupings', { 'faceIds' : batch }), None
+        except OxfordError as e:
+            return None, e
+
+    def done(batch, result):
+        if result[1]:
+            raise result[1]
+        clusters.extend(result[0]['groups'])
+        clusters.extend([faceid] for faceid in result[0]['messyGroup'])
+
+    run_batch(chunks(faceids, GROUPING_BATCH), work, done, concurrency)
+    representatives = dict((cluster[0], cluster) for cluster in clusters)
+    if len(representatives) >= len(faceids):
+        # nothing grouped within a chunk, another round wouldn't shrink the
+        # problem, but faces in different chunks may still go together
+        return group_across(client, faceids, concurrency)
+    groups, messy = group_faces(client, list(representatives), concurrency)
+    merged = [[faceid for representative in group for faceid in representatives[representative]] for group in groups]
+    merged.extend(representatives[representative] for representative in messy if len(representatives[representative]) > 1)
+    return merged, [representative for representative in messy if len(representatives[representative]) == 1]
+
+# Group faces that no chunk of them grouped: every two halves of a chunk are
+# posted together, so every two faces are in some call together, and the
+# groups that come back are joined where they share a face
+def group_across(client, faceids, concurrency):
+    halves = chunks(faceids, GROUPING_BATCH // 2)
+    parent = dict((faceid, faceid) for faceid in faceids)
+
+    def root(faceid):
+        while parent[faceid] != faceid:
+            parent[faceid] = parent[parent[faceid]]
+            faceid = parent[faceid]
+        return faceid
+
+    def work(pair):
+        try:
+            return post_json(client, 'face', '/groupings', { 'faceIds' : halves[pair[0]] + halves[pair[1]] }), None
+        except OxfordError as e:
+            return None, e
+
+    def done(pair, result):
+        if result[1]:
+            raise result[1]
+        for group in result[0]['groups']:
+            for faceid in group[1:]:
+                parent[root(faceid)] = root(group[0])
 
+    pairs = [(i, j) for i in range(len(halves)) for j in range(i + 1, len(halves))]
+    run_batch(pairs, work, done, concurrency)
+    clusters = collections.OrderedDict()
+    for faceid in faceids:
+        clusters.setdefault(root(faceid), []).append(faceid)
+    groups = [cluster for cluster in clusters.values() if len(cluster) > 1]
+    return groups, [cluster[0] for cluster in clusters.values() if len(cluster) == 1]
+
+def load_numpy(option):
+    try:
+        # NumPy is optional, only --local, the result store and reports need it
+        # http://www.numpy.org/
+        import numpy
+    except ImportError:
+        raise click.UsageError('%s needs numpy, pip install numpy.' % option)
+    return numpy
+
+# The local alternative to findsimilars and groupings: each face becomes the
+# vector of its landmarks, centred on their mean and scaled by the face's
+# width, and faces are compared by the root mean square distance between
+# their landmarks. Comparisons are vectorized with NumPy a block of rows at a
+# time, so memory stays bounded for thousands of faces.
+class LandmarkIndex(object):
+
+    def __init__(self, faces):
+        numpy = self.numpy = load_numpy('--local')
+        self.faces = faces
+        self.faceids = [face['faceId'] for face in faces]
+        names = sorted(set.intersection(*[set(face['faceLandmarks']) for face in faces])) if faces else []
+        points = numpy.array([[(face['faceLandmarks'][name]['x'], face['faceLandmarks'][name]['y']) for name in names]
+                              for face in faces], dtype=numpy.float64).reshape(len(faces), len(names), 2)
+        widths = numpy.array([face['faceRectangle']['width'] for face in faces], dtype=numpy.float64)
+        points = (points - points.mean(axis=1)[:, None, :]) / widths[:, None, None]
+        self.vectors = points.reshape(len(faces), -1) / numpy.sqrt(max(1, len(names)))
+        self.norms = (self.vectors ** 2).sum(axis=1)
+
+    # the distance from rows to every face
+    def distances(self, rows):
+        numpy = self.numpy
+        squared = self.norms[rows][:, None] + self.norms[None, :] - 2 * self.vectors[rows].dot(self.vectors.T)
+        return numpy.sqrt(numpy.maximum(squared, 0))
+
+    def similar(self, faceid, candidates, threshold):
+        row = self.faceids.index(faceid)
+        distance = self.distances([row])[0]
+        candidates = set(candidates or self.faceids) - set([faceid])
+        matches = [{ 'faceId' : self.faceids[i], 'distance' : float(distance[i]) }
+                   for i in self.numpy.argsort(distance) if self.faceids[i] in candidates and distance[i] <= threshold]
+        return matches
+
+    # connected components of the faces within threshold of each other
+    def groups(self, threshold, block=1024):
+        numpy = self.numpy
+        parent = range(len(self.faceids))
+
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for start in range(0, len(self.faceids), block):
+            rows = numpy.arange(start, min(start + block, len(self.faceids)))
+            near = numpy.nonzero(self.distances(rows) <= threshold)
+            for i, j in zip(rows[near[0]], near[1]):
+                if j > i:
+                    parent[root(i)] = root(j)
+        clusters = collections.OrderedDict()
+        for i, faceid in enumerate(self.faceids):
+            clusters.setdefault(root(i), []).append(faceid)
+        groups = [cluster for cluster in clusters.values() if len(cluster) > 1]
+        return groups, [cluster[0] for cluster in clusters.values() if len(cluster) == 1]
+
+# the faces for --local, from --detections, limited to the faceIds asked about
+def local_index(detections, faceids=None):
+    if detections is None:
+        raise click.UsageError('--local needs --detections, the detect output holding the faces\' landmarks.')
+    faces = read_faces(detections)
+    if faceids:
+        wanted = set(faceids)
+        faces = [face for face in faces if face['faceId'] in wanted]
+    # a face given twice, e.g. in two detect outputs, is one face
+    unique = collections.OrderedDict()
+    for face in faces:
+        unique.setdefault(face['faceId'], face)
+    return LandmarkIndex(unique.values())
+
+# find similar faces
 @click.command(context_settings=CONTEXT_SETTINGS)
-def verify():
-    click.echo('Analyzes two faces and determine whether they are from the same person.')
+@click.option('--candidates-file', type=LocalFile('r'), default=None, help='Read candidate faceIds, or detect output, from this file (- for stdin).')
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight.')
+@click.option('--local', is_flag=True, help='Compare face landmarks locally instead of calling the api (needs numpy).')
+@click.option('--detections', type=LocalFile('r'), default=None, help='With --local, the detect output holding the faces (- for stdin).')
+@click.option('--threshold', default=0.05, help='With --local, the largest landmark distance, as a fraction of face width, that counts as similar.')
+@click.argument('faceid')
+@click.argument('candidates', nargs=-1)
+@click.pass_context
+def find_similar(ctx, candidates_file, concurrency, local, detections, threshold, faceid, candidates):
+    """Finds similar-looking faces of a specified face from a list of candidate faces."""
+    candidates = list(candidates)
+    if candidates_file is not None:
+        candidates.extend(read_faceids(candidates_file))
+    if local:
+        index = local_index(detections)
+        if faceid not in index.faceids:
+            raise click.UsageError('%s is not in --detections.' % faceid)
+        return echo_json(index.similar(faceid, candidates, threshold))
+    if not candidates:
+        raise click.UsageError('No candidate faceIds.')
+    echo_json(find_similar_faces(ctx.obj['client'], faceid, candidates, concurrency))
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--faceids-file', type=LocalFile('r'), default=None, help='Read faceIds, or detect output, from this file (- for stdin).')
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight.')
+@click.option('--local', is_flag=True, help='Compare face landmarks locally instead of calling the api (needs numpy).')
+@click.option('--detections', type=LocalFile('r'), default=None, help='With --local, the detect output holding the faces (- for stdin).')
+@click.option('--threshold', default=0.05, help='With --local, the largest landmark distance, as a fraction of face width, that counts as similar.')
+@click.argument('faceids', nargs=-1)
+@click.pass_context
+def find_groups(ctx, faceids_file, concurrency, local, detections, threshold, faceids):
+    """Divides candidate faces into groups based on face similarity."""
+    faceids = list(faceids)
+    if faceids_file is not None:
+        faceids.extend(read_faceids(faceids_file))
+    if local:
+        groups, messy = local_index(detections, faceids).groups(threshold)
+    elif faceids:
+        groups, messy = group_faces(ctx.obj['client'], faceids, concurrency)
+    else:
+        raise click.UsageError('No faceIds to group.')
+    echo_json({ 'groups' : groups, 'messyGroup' : messy })
+
+# Feeds detections into identify calls as they finish. FaceIds are packed
+# into full identify batches, or sent after linger seconds, on a pool of
+# their own, so one image is being identified while the next is still being
+# detected. done(image, faces) gets each image once all its faces are back.
+class Recognizer(object):
+
+    def __init__(self, client, persongroupid, max_candidates, concurrency, done, linger=0.5):
+        self.client = client
+        self.persongroupid = persongroupid
+        self.max_candidates = max_candidates
+        self.done = done
+        self.linger = linger
+        self.executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.lock = threading.Lock()
+        self.queue = []
+        self.timer = None
+        # the images waiting on faces, by the order they were added, as the
+        # same image can come twice
+        self.images = {}
+        self.added = 0
+        # the faces waiting on each faceId, a cached detection of the same
+        # content gives another image the same faceIds
+        self.faces = {}
+        self.sent = []
+
+    def add(self, image, faces):
+        if not faces:
+            return self.done(image, [])
+        with self.lock:
+            self.added += 1
+            self.images[self.added] = { 'image' : image, 'faces' : faces, 'left' : len(faces) }
+            for face in faces:
+                # each faceId is identified once, for every face waiting on it
+                if face['faceId'] not in self.faces:
+                    self.faces[face['faceId']] = []
+                    self.queue.append(face['faceId'])
+                self.faces[face['faceId']].append((self.added, face))
+            while len(self.queue) >= IDENTIFY_BATCH:
+                self.send(IDENTIFY_BATCH)
+            if self.queue and self.timer is None:
+                self.timer = threading.Timer(self.linger, with_command(self.flush))
+                self.timer.daemon = True
+                self.timer.start()
+
+    # send up to count waiting faceIds, called with the lock held
+    def send(self, count=None):
+        count = count or len(self.queue)
+        batch, self.queue = self.queue[:count], self.queue[count:]
+        if batch:
+            # the failed ones are kept for finish to raise
+            self.sent = [future for future in self.sent if not future.done() or future.exception()]
+            self.sent.append(self.executor.submit(with_command(self.identify), batch))
+        if not self.queue and self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            self.send()
+
+    def identify(self, faceids):
+        results, error = identify_batch(self.client, faceids, self.persongroupid, self.max_candidates)
+        candidates = dict((item['faceId'], item['candidates']) for item in results or [])
+        self.answer(faceids, lambda face: face.update({ 'error' : error } if error else { 'candidates' : candidates.get(face['faceId'], []) }))
+
+    # update every face waiting on these faceIds, handing back the images
+    # that have all their faces
+    def answer(self, faceids, update):
+        finished = []
+        with self.lock:
+            for faceid in faceids:
+                for added, face in self.faces.pop(faceid, []):
+                    update(face)
+                    entry = self.images[added]
+                    entry['left'] -= 1
+                    if not entry['left']:
+                        finished.append(self.images.pop(added))
+        for entry in finished:
+            self.done(entry['image'], entry['faces'])
+
+    # wait for every identify call to come back, raising the first that
+    # failed once the faces it left waiting are handed back as errors
+    def finish(self):
+        with self.lock:
+            self.send()
+        futures.wait(self.sent)
+        self.executor.shutdown()
+        failed = [future for future in self.sent if future.exception()]
+        with self.lock:
+            waiting = list(self.faces)
+        if waiting:
+            error = str(failed[0].exception()) if failed else 'Not identified.'
+            self.answer(waiting, lambda face: face.update({ 'error' : error }))
+        for future in failed:
+            future.result()
+
+# detect and identify the faces in many images, one json result per line
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--persongroupid', required=True, help='Target person group\'s ID')
+@click.option('--maxnumofcandidatesreturned', default=1, help='Maximum number of person candidates returned for each face, 1-5.')
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight for each stage.')
+@click.option('--engine', default='thread', type=click.Choice(['thread', 'async']), help='Run detections on a thread pool, or on an event loop (needs tornado).')
+@click.option('--linger', default=0.5, help='Seconds to wait for a full batch of faceIds before identifying a partial one.')
+@click.option('--journal', default=None, type=LocalPath(dir_okay=False), help='Record the progress of each image in this SQLite file.')
+@click.option('--resume', is_flag=True, help='Skip the images the journal has done or failed.')
+@click.option('--retry-failed', is_flag=True, help='Skip the images the journal has done, run the failed ones again.')
+@click.option('--shard', default=None, callback=parse_shard, help='Only run the images in shard i of N, e.g. 0/4.')
+@click.argument('sources', nargs=-1, required=True)
+@click.pass_context
+def recognize(ctx, persongroupid, maxnumofcandidatesreturned, concurrency, engine, linger, journal, resume, retry_failed, shard, sources):
+    """Detect and identify faces in a directory, glob or manifest of images ('-' reads the manifest from stdin)."""
+    job = BatchJob(ctx, journal, resume, retry_failed, shard)
+
+    # an image whose identify call failed is journaled as failed, to retry
+    def recognized(image, faces):
+        record = { 'image' : image, 'status' : 200, 'faces' : faces }
+        job.finished(image, record, failed=any('error' in face for face in faces))
+        echo_line(record)
+
+    recognizer = Recognizer(ctx.obj['client'], persongroupid, maxnumofcandidatesreturned,
+                            concurrency, recognized, linger)
+
+    def detected(image, resp, error):
+        if error is None and resp.status_code == 200:
+            recognizer.add(image, resp.json())
+        else:
+            record = batch_record(image, resp, error, 'faces')
+            job.finished(image, record)
+            echo_line(record)
+
+    try:
+        post_images(ctx, job.images(expand_sources(sources)), 'face', '/detections', detected,
+                    params=detection_params(False, False, False, False),
+                    concurrency=concurrency, engine=engine)
+    finally:
+        try:
+            recognizer.finish()
+        finally:
+            job.close()
+
+# read faceId pairs, one a line as 'faceId1 faceId2', 'faceId1,faceId2' or
+# json with faceId1 and faceId2
+def read_pairs(f):
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            pair = json.loads(line)
+            yield pair['faceId1'], pair['faceId2']
+        except (ValueError, KeyError, TypeError):
+            fields = line.replace(',', ' ').split()
+            if len(fields) == 2:
+                yield fields[0], fields[1]
+
+# The face pairs of set a against set b worth asking the api about. Pairs of
+# faces holding a similar head pose whose landmarks are further apart than
+# threshold are clearly different people and are pruned. Landmarks move with
+# the pose, so faces in different poses (or without landmarks) are kept.
+# A face is never paired with itself, and two faces in both sets are paired
+# once, not once each way.
+def cross_pairs(faces_a, faces_b, threshold, pose_tolerance, pruned, block=1024):
+    both = set(face['faceId'] for face in faces_a) & set(face['faceId'] for face in faces_b)
+    landmarked = [face for face in faces_a + [face for face in faces_b if face['faceId'] not in both]
+                  if face.get('faceLandmarks')]
+    index = LandmarkIndex(landmarked) if threshold and landmarked else None
+    rows = dict((face['faceId'], i) for i, face in enumerate(landmarked))
+
+    def pose(face):
+        head = face.get('attributes', {}).get('headPose')
+        return head and (head.get('yaw', 0), head.get('roll', 0))
+
+    for start in range(0, len(faces_a), block):
+        batch = faces_a[start:start + block]
+        known = [face for face in batch if face['faceId'] in rows]
+        distances = dict(zip([face['faceId'] for face in known],
+                             index.distances([rows[face['faceId']] for face in known]) if index and known else []))
+        for a in batch:
+            for b in faces_b:
+                if a['faceId'] == b['faceId'] or a['faceId'] in both and b['faceId'] in both and a['faceId'] > b['faceId']:
+                    continue
+                if a['faceId'] in distances and b['faceId'] in rows:
+                    pose_a, pose_b = pose(a), pose(b)
+                    if pose_a and pose_b and all(abs(x - y) <= pose_tolerance for x, y in zip(pose_a, pose_b)) \
+                            and distances[a['faceId']][rows[b['faceId']]] > threshold:
+                        pruned[0] += 1
+                        continue
+                yield a['faceId'], b['faceId']
+
+# the faces in a detect output file, or bare faceIds
+def read_face_set(f):
+    faces = collections.OrderedDict()
+    for document in read_documents(f):
+        if isinstance(document, basestring):
+            faces.setdefault(document, { 'faceId' : document })
+            continue
+        for face in collect_faces(document, []):
+            faces[face['faceId']] = face
+        for faceid in collect_faceids(document, []):
+            faces.setdefault(faceid, { 'faceId' : faceid })
+    return list(faces.values())
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--pairs', type=LocalFile('r'), default=None, help='Verify the faceId pairs in this file, one pair a line (- for stdin).')
+@click.option('--set-a', type=LocalFile('r'), default=None, help='Verify every face in this detect output, or list of faceIds...')
+@click.option('--set-b', type=LocalFile('r'), default=None, help='...against every face in this one.')
+@click.option('--prune-threshold', default=0.1, help='With --set-a/--set-b, skip pairs in a similar pose whose landmarks are further apart than this fraction of face width (0 to verify every pair, needs numpy otherwise).')
+@click.option('--pose-tolerance', default=15.0, help='Degrees of yaw and roll within which two faces count as the same pose for pruning.')
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight.')
+@click.argument('faceids', nargs=-1)
+@click.pass_context
+def verify(ctx, pairs, set_a, set_b, prune_threshold, pose_tolerance, concurrency, faceids):
+    """Analyzes two faces and determine whether they are from the same person."""
+    client = ctx.obj['client']
+    if len(faceids) == 2:
+        resp = client.post('face', '/verifications', data=json.dumps({ 'faceId1' : faceids[0], 'faceId2' : faceids[1] }), headers=JSON_HEADERS)
+        return echo_response(resp)
+    pruned = [0]
+    if pairs is not None:
+        todo = read_pairs(pairs)
+    elif set_a is not None and set_b is not None:
+        todo = cross_pairs(read_face_set(set_a), read_face_set(set_b), prune_threshold, pose_tolerance, pruned)
+    else:
+        raise click.UsageError('Give two faceIds, --pairs, or --set-a and --set-b.')
+    counts = { 'verified' : 0, 'failed' : 0 }
+
+    def work(pair):
+        try:
+            return post_json(client, 'face', '/verifications', { 'faceId1' : pair[0], 'faceId2' : pair[1] }), None
+        except OxfordError as e:
+            return None, str(e)
+
+    def done(pair, result):
+        record = { 'faceId1' : pair[0], 'faceId2' : pair[1] }
+        if result[1]:
+            record['error'] = result[1]
+            counts['failed'] += 1
+        else:
+            record.update(result[0])
+            counts['verified'] += 1
+        echo_line(record)
+
+    run_batch(todo, work, done, concurrency)
+    click.echo('Verified %d pairs, %d failed, %d pruned locally' % (counts['verified'], counts['failed'], pruned[0]), err=True)
+
+# A local SQLite mirror of the PersonGroups, their persons and the persons'
+# faceIds, kept up to date by 'persongroup sync' and read by --local.
+class Mirror(object):
+
+    SCHEMA = """
+    create table if not exists persongroups (
+        personGroupId text primary key, lastAction text, json text, syncedAt real);
+    create table if not exists persons (
+        personGroupId text, personId text, name text, json text,
+        primary key (personGroupId, personId));
+    create table if not exists faces (
+        faceId text, personGroupId text, personId text,
+        primary key (personGroupId, faceId));
+    create index if not exists faces_by_id on faces (faceId);
+    create index if not exists persons_by_name on persons (name);
+    """
+
+    def __init__(self, fname):
+        directory = os.path.dirname(fname)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(fname)
+        self.db.executescript(self.SCHEMA)
+
+    def persongroups(self):
+        return [json.loads(row[0]) for row in
+                self.db.execute('select json from persongroups order by personGroupId')]
+
+    def persongroup(self, persongroupid):
+        row = self.db.execute('select json from persongroups where personGroupId = ?', (persongroupid,)).fetchone()
+        return row and json.loads(row[0])
+
+    def persons(self, persongroupid):
+        return [json.loads(row[0]) for row in
+                self.db.execute('select json from persons where personGroupId = ? order by personId', (persongroupid,))]
+
+    def person(self, persongroupid, personid):
+        row = self.db.execute('select json from persons where personGroupId = ? and personId = ?',
+                              (persongroupid, personid)).fetchone()
+        return row and json.loads(row[0])
+
+    # the PersonGroups and persons a faceId was enrolled under
+    def owners(self, faceid):
+        return [{ 'personGroupId' : row[0], 'personId' : row[1], 'name' : row[2] } for row in self.db.execute(
+            'select f.personGroupId, f.personId, p.name from faces f join persons p '
+            'on p.personGroupId = f.personGroupId and p.personId = f.personId where f.faceId = ?', (faceid,))]
+
+    # the training lastActionDateTime we synced a PersonGroup at
+    def last_action(self, persongroupid):
+        row = self.db.execute('select lastAction from persongroups where personGroupId = ?', (persongroupid,)).fetchone()
+        return row and row[0]
+
+    # forget PersonGroups that no longer exist, returning how many went
+    def prune(self, persongroupids):
+        gone = [row[0] for row in self.db.execute('select personGroupId from persongroups')
+                if row[0] not in persongroupids]
+        with self.db:
+            for persongroupid in gone:
+                for table in ('persongroups', 'persons', 'faces'):
+                    self.db.execute('delete from %s where personGroupId = ?' % table, (persongroupid,))
+        return len(gone)
+
+    def save_persongroup(self, persongroup, last_action):
+        with self.db:
+            self.db.execute('insert or replace into persongroups values (?, ?, ?, ?)',
+                            (persongroup['personGroupId'], last_action, json.dumps(persongroup), time.time()))
+
+    # replace a PersonGroup's persons, returning how many were added, changed or removed
+    def save_persons(self, persongroupid, persons):
+        current = dict(self.db.execute('select personId, json from persons where personGroupId = ?', (persongroupid,)))
+        changes = 0
+        with self.db:
+            for person in persons:
+                data = json.dumps(person, sort_keys=True)
+                if current.pop(person['personId'], None) == data:
+                    continue
+                changes += 1
+                self.db.execute('insert or replace into persons values (?, ?, ?, ?)',
+                                (persongroupid, person['personId'], person.get('name'), data))
+                self.db.execute('delete from faces where personGroupId = ? and personId = ?',
+                                (persongroupid, person['personId']))
+                self.db.executemany('insert or replace into faces values (?, ?, ?)',
+                                    [(faceid, persongroupid, person['personId']) for faceid in person.get('faceIds', [])])
+            for personid in current:
+                changes += 1
+                self.db.execute('delete from persons where personGroupId = ? and personId = ?', (persongroupid, personid))
+                self.db.execute('delete from faces where personGroupId = ? and personId = ?', (persongroupid, personid))
+        return changes
+
+def open_mirror(ctx):
+    if 'mirror' not in ctx.obj:
+        ctx.obj['mirror'] = Mirror(ctx.obj['mirror_db'])
+    return ctx.obj['mirror']
+
+# print an answer from the mirror, or say it isn't there
+def echo_local(data, what):
+    if data is None:
+        print "%s is not in the local mirror, run persongroup sync" % what
+    else:
+        echo_json(data)
 
 #
 # PersonGroup sub command: https://www.projectoxford.ai/doc/face/overview
 #
-@click.group()
+@click.group(cls=LazyGroup)
 @click.pass_context
 def persongroup(ctx):
     pass
 
 @click.command(context_settings=CONTEXT_SETTINGS)
-@click.option('--persongroupid', default=str(uuid.uuid4()), help='User-provided name.')
+@click.option('--persongroupid', default=lambda: str(uuid.uuid4()), help='User-provided name.')
 @click.option('--customdata', default='', help='User-provided data attached to the person group. The size limit is 16KB.')
 @click.argument('name')
 @click.pass_context
 def create_persongroup(ctx, customdata, name, persongroupid):
-    params = dict()
-    persongroups_create_path = '/persongroups/%s' % persongroupid
-    headers = {
-    'Content-Type' : 'application/json',
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    persongroup_create_url = ctx.obj['oxford_url'] + persongroups_create_path
     payload = json.dumps({
         'name' : name,
         'userData' : customdata,
         })
-    try:
-        resp = requests.put(persongroup_create_url, data=payload, params=params, headers=headers)
-        if resp.status_code == 200:
-            print "Created PersonGroup with id %s" % persongroupid
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
-            
+    resp = ctx.obj['client'].put('face', '/persongroups/%s' % persongroupid, data=payload, headers=JSON_HEADERS)
+    if resp.status_code == 200:
+        print "Created PersonGroup with id %s" % persongroupid
+    else:
+        print error_message(resp)
+
 @click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--local', is_flag=True, help='Answer from the local mirror.')
 @click.pass_context
-def retrieve_all_persongroups(ctx):
-    persongroups_path = '/persongroups'
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    persongroup_get_url = ctx.obj['oxford_url'] + persongroups_path
-    try:
-        resp = requests.get(persongroup_get_url, params=None, headers=headers)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+def retrieve_all_persongroups(ctx, local):
+    if local:
+        return echo_json(open_mirror(ctx).persongroups())
+    resp = ctx.obj['client'].get('face', '/persongroups')
+    echo_response(resp)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--local', is_flag=True, help='Answer from the local mirror.')
 @click.argument('persongroupid', required=True)
 @click.pass_context
-def retrieve_persongroup(ctx, persongroupid):
-    persongroups_path = '/persongroups/%s' % persongroupid
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    persongroup_get_url = ctx.obj['oxford_url'] + persongroups_path
-    try:
-        resp = requests.get(persongroup_get_url, params=None, headers=headers)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+def retrieve_persongroup(ctx, local, persongroupid):
+    if local:
+        return echo_local(open_mirror(ctx).persongroup(persongroupid), "PersonGroup %s" % persongroupid)
+    resp = ctx.obj['client'].get('face', '/persongroups/%s' % persongroupid)
+    echo_response(resp)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--local', is_flag=True, help='Answer from the local mirror.')
 @click.argument('persongroupid', required=True)
 @click.pass_context
-def list_people_in_persongroup(ctx, persongroupid):
-    persongroups_path = '/persongroups/%s/persons' % persongroupid
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    persongroup_get_url = ctx.obj['oxford_url'] + persongroups_path
-    try:
-        resp = requests.get(persongroup_get_url, params=None, headers=headers)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
-        
+def list_people_in_persongroup(ctx, local, persongroupid):
+    if local:
+        return echo_json(open_mirror(ctx).persons(persongroupid))
+    resp = ctx.obj['client'].get('face', '/persongroups/%s/persons' % persongroupid)
+    echo_response(resp)
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--full', is_flag=True, help='Refetch every PersonGroup\'s persons, changed or not.')
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight.')
+@click.pass_context
+def sync_persongroups(ctx, full, concurrency):
+    """Bring the local mirror of PersonGroups, persons and faceIds up to date.
+
+    A PersonGroup's persons are only refetched when its name, data or training
+    time changed since the last sync; use --full after enrolling without training.
+    """
+    client = ctx.obj['client']
+    mirror = open_mirror(ctx)
+    resp = client.get('face', '/persongroups')
+    if resp.status_code != 200:
+        raise click.ClickException(error_message(resp))
+    persongroups = resp.json()
+    removed = mirror.prune(set(group['personGroupId'] for group in persongroups))
+    stored = dict((group['personGroupId'], group) for group in mirror.persongroups())
+    last_actions = dict((group['personGroupId'], mirror.last_action(group['personGroupId'])) for group in persongroups)
+
+    # the training time tells us whether a PersonGroup changed since we last
+    # looked; fetches run on the pool, only this thread touches the mirror
+    def fetch(group):
+        persongroupid = group['personGroupId']
+        try:
+            status = client.get('face', '/persongroups/%s/training' % persongroupid)
+            last_action = status.json().get('lastActionDateTime') if status.status_code == 200 else None
+            if not full and last_action and last_action == last_actions.get(persongroupid) \
+                    and stored.get(persongroupid) == group:
+                return last_action, None, None
+            persons = client.get('face', '/persongroups/%s/persons' % persongroupid)
+            if persons.status_code != 200:
+                return None, None, error_message(persons)
+            return last_action, persons.json(), None
+        except OxfordError as e:
+            return None, None, str(e)
+
+    counts = { 'persongroups' : len(persongroups), 'fetched' : 0, 'changed' : 0, 'removed' : removed }
+
+    def fetched(group, result):
+        last_action, persons, error = result
+        if error:
+            click.echo('%s: %s' % (group['personGroupId'], error), err=True)
+        elif persons is not None:
+            counts['fetched'] += 1
+            counts['changed'] += mirror.save_persons(group['personGroupId'], persons)
+            mirror.save_persongroup(group, last_action)
+
+    run_batch(persongroups, fetch, fetched, concurrency)
+    print "Synced %(persongroups)d PersonGroups, refetched %(fetched)d, %(changed)d persons changed, %(removed)d PersonGroups removed" % counts
+
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.argument('persongroupid', required=True)
 @click.pass_context
 def training_status(ctx, persongroupid):
-    persongroups_path = '/persongroups/%s/training' % persongroupid
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    persongroup_get_url = ctx.obj['oxford_url'] + persongroups_path
-    try:
-        resp = requests.get(persongroup_get_url, params=None, headers=headers)
+    resp = ctx.obj['client'].get('face', '/persongroups/%s/training' % persongroupid)
+    echo_response(resp)
+
+# training statuses that won't change again
+TRAINING_DONE = ('succeeded', 'failed')
+
+# Poll a PersonGroup's training status over the shared session until it is
+# done or timeout seconds pass, handing every change of status to changed().
+# Polls start quick and back off towards max_interval while nothing changes.
+def wait_for_training(client, persongroupid, timeout, changed, interval=0.5, max_interval=10.0):
+    deadline = time.time() + timeout
+    delay = interval
+    last = None
+    while True:
+        resp = client.get('face', '/persongroups/%s/training' % persongroupid)
         if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
+            status = resp.json()
         else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+            status = { 'status' : 'error', 'message' : error_message(resp) }
+        status['personGroupId'] = persongroupid
+        if status.get('status') != last:
+            changed(status)
+            last = status.get('status')
+            delay = interval
+        else:
+            delay = min(max_interval, delay * 1.5)
+        if last in TRAINING_DONE or last == 'error':
+            return status
+        if time.time() + delay > deadline:
+            status = { 'personGroupId' : persongroupid, 'status' : 'timeout', 'lastStatus' : last }
+            changed(status)
+            return status
+        time.sleep(delay)
+
+# wait for several PersonGroups at once, streaming each change of status,
+# and exit non-zero unless they all succeed
+def wait_for_persongroups(ctx, persongroupids, timeout):
+    client = ctx.obj['client']
+    results = []
+
+    def work(persongroupid):
+        return wait_for_training(client, persongroupid, timeout, echo_line)
+
+    run_batch(persongroupids, work, lambda persongroupid, status: results.append(status), len(persongroupids))
+    if any(status['status'] != 'succeeded' for status in results):
+        ctx.exit(1)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--wait', is_flag=True, help='Wait for training to finish, printing each change of status.')
+@click.option('--timeout', default=1800.0, help='Seconds to wait for training.')
 @click.argument('persongroupid', required=True)
 @click.pass_context
-def train_persongroup(ctx, persongroupid):
-    persongroups_path = '/persongroups/%s/training' % persongroupid
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    persongroup_get_url = ctx.obj['oxford_url'] + persongroups_path
-    try:
-        resp = requests.post(persongroup_get_url, params=None, headers=headers)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+def train_persongroup(ctx, wait, timeout, persongroupid):
+    resp = ctx.obj['client'].post('face', '/persongroups/%s/training' % persongroupid)
+    if resp.status_code >= 300:
+        print error_message(resp)
+    elif wait:
+        wait_for_persongroups(ctx, [persongroupid], timeout)
+    else:
+        print "Training PersonGroup %s" % persongroupid
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--timeout', default=1800.0, help='Seconds to wait for training.')
+@click.argument('persongroupids', nargs=-1, required=True)
+@click.pass_context
+def wait_persongroup(ctx, timeout, persongroupids):
+    """Wait for PersonGroups to finish training, printing each change of status."""
+    wait_for_persongroups(ctx, persongroupids, timeout)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--customdata', default='', help='User-provided data attached to the person group. The size limit is 16KB.')
@@ -283,46 +2869,212 @@ def train_persongroup(ctx, persongroupid):
 @click.argument('persongroupid', required=True)
 @click.pass_context
 def update_persongroup(ctx, customdata, name, persongroupid):
-    params = dict()
-    persongroups_update_path = '/persongroups/%s' % persongroupid
-    headers = {
-    'Content-Type' : 'application/json',
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    persongroup_create_url = ctx.obj['oxford_url'] + persongroups_update_path
     payload = json.dumps({
         'name' : name,
         'userData' : customdata,
         })
-    try:
-        resp = requests.patch(persongroup_create_url, data=payload, params=params, headers=headers)
-        if resp.status_code == 200:
-            print "Created PersonGroup with name %s" % persongroupid
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e	
+    resp = ctx.obj['client'].patch('face', '/persongroups/%s' % persongroupid, data=payload, headers=JSON_HEADERS)
+    if resp.status_code == 200:
+        print "Created PersonGroup with name %s" % persongroupid
+    else:
+        print error_message(resp)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.argument('persongroupid', required=True)
 @click.pass_context
 def delete_persongroup(ctx, persongroupid):
-    persongroups_path = '/persongroups/%s' % persongroupid
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    persongroup_get_url = ctx.obj['oxford_url'] + persongroups_path
+    resp = ctx.obj['client'].delete('face', '/persongroups/%s' % persongroupid)
+    echo_error(resp)
+
+# faceIds from detect expire after 24 hours, redetect anything older than this
+FACEID_TTL = 23 * 3600
+
+# the people to import and their images, from a directory holding a folder of
+# images per person, or a csv of person,image rows
+def read_enrollment(source):
+    people = collections.OrderedDict()
+    if os.path.isdir(local_path(source)):
+        for name in sorted(os.listdir(local_path(source))):
+            if os.path.isdir(os.path.join(local_path(source), name)):
+                people[name] = list(expand_sources([os.path.join(source, name)]))
+    else:
+        with open(local_path(source), 'rb') as f:
+            for i, row in enumerate(csv.reader(f)):
+                if len(row) < 2 or i == 0 and row[0].strip().lower() in ('person', 'name'):
+                    continue
+                people.setdefault(row[0].strip(), []).append(row[1].strip())
+    return people
+
+# An append-only journal of the steps an import has finished, one json record
+# per line, replayed on start so an interrupted import resumes where it stopped.
+class ImportJournal(object):
+
+    def __init__(self, fname):
+        self.group = False
+        self.trained = False
+        self.detections = {}
+        self.persons = {}
+        self.faces = set()
+        if os.path.isfile(fname):
+            with open(fname, 'r') as f:
+                for line in f:
+                    try:
+                        self.apply(json.loads(line))
+                    except ValueError:
+                        # a line cut short when the last run died
+                        pass
+        self.f = open(fname, 'a')
+
+    def apply(self, record):
+        step = record['step']
+        if step == 'group':
+            self.group = True
+        elif step == 'detect':
+            self.detections[record['image']] = record
+        elif step == 'person':
+            self.persons[record['person']] = record['personId']
+            self.trained = False
+        elif step == 'face':
+            self.faces.add((record['personId'], record['faceId']))
+            self.trained = False
+        elif step == 'train':
+            self.trained = True
+
+    def write(self, step, **record):
+        record['step'] = step
+        self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.f.flush()
+        self.apply(record)
+
+    # the faceId detected in an image, if it was detected recently enough to use
+    def faceid(self, image):
+        record = self.detections.get(image)
+        if record and time.time() - record['time'] < FACEID_TTL:
+            return record['faceId']
+
+    def close(self):
+        self.f.close()
+
+# the largest face found in a detection, or None
+def largest_face(faces):
+    if faces:
+        return max(faces, key=lambda face: face['faceRectangle']['width'] * face['faceRectangle']['height'])
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--name', default=None, help='Create the PersonGroup with this name first.')
+@click.option('--journal', default=None, help='Journal file, defaults to PERSONGROUPID.import.jsonl.')
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight.')
+@click.option('--train/--no-train', default=True, help='Train the PersonGroup once everyone is enrolled.')
+@click.argument('persongroupid')
+@click.argument('source')
+@click.pass_context
+def import_persongroup(ctx, name, journal, concurrency, train, persongroupid, source):
+    """Enroll people from a directory of per-person folders, or a csv of person,image rows."""
+    client = ctx.obj['client']
+    journal = ImportJournal(local_path(journal or '%s.import.jsonl' % persongroupid))
+    people = read_enrollment(source)
+    # faceIds must be fresh, so detections don't come from the result cache
+    ctx.obj['use_cache'] = False
+    failed = []
+
     try:
-        resp = requests.delete(persongroup_get_url, params=None, headers=headers)
-        if resp.status_code != 200:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+        if name and not journal.group:
+            payload = json.dumps({ 'name' : name, 'userData' : '' })
+            resp = client.put('face', '/persongroups/%s' % persongroupid, data=payload, headers=JSON_HEADERS)
+            if resp.status_code != 200:
+                raise click.ClickException(error_message(resp))
+            journal.write('group', personGroupId=persongroupid)
+
+        # detect the face in every image we don't have a fresh faceId for,
+        # unless its face is already enrolled
+        enrolled = set(faceid for _, faceid in journal.faces)
+
+        def needs_detection(image):
+            record = journal.detections.get(image)
+            if not record:
+                return True
+            return record['faceId'] and record['faceId'] not in enrolled and not journal.faceid(image)
+
+        images = [image for images in people.values() for image in images if needs_detection(image)]
+
+        def detected(image, resp, error):
+            if error is None and resp.status_code == 200:
+                face = largest_face(resp.json())
+                journal.write('detect', image=image, time=time.time(), faceId=face and face['faceId'])
+                if not face:
+                    failed.append((image, 'no face found'))
+            else:
+                failed.append((image, str(error) if error is not None else error_message(resp)))
+
+        post_images(ctx, images, 'face', '/detections', detected,
+                    params=detection_params(False, False, False, False), concurrency=concurrency)
+
+        # create each person with their first face
+        def faceids(person):
+            return [faceid for faceid in map(journal.faceid, people[person]) if faceid]
+
+        def create(person):
+            payload = json.dumps({
+                'name' : person,
+                'userData' : "Imported %s" % str(datetime.datetime.now()),
+                'faceIds' : faceids(person)[:1],
+                })
+            try:
+                return client.post('face', '/persongroups/%s/persons' % persongroupid, data=payload, headers=JSON_HEADERS), None
+            except OxfordError as e:
+                return None, e
+
+        def created(person, result):
+            resp, error = result
+            if error is None and resp.status_code == 200:
+                journal.write('person', person=person, personId=resp.json()['personId'])
+                journal.write('face', personId=journal.persons[person], faceId=faceids(person)[0])
+            else:
+                failed.append((person, str(error) if error is not None else error_message(resp)))
+
+        run_batch([person for person in people if person not in journal.persons and faceids(person)],
+                  create, created, concurrency)
+
+        # attach everyone's other faces
+        def attach(face):
+            personid, faceid = face
+            payload = json.dumps({ 'userData' : "Imported %s" % str(datetime.datetime.now()) })
+            try:
+                return client.put('face', '/persongroups/%s/persons/%s/faces/%s' % (persongroupid, personid, faceid),
+                                  data=payload, headers=JSON_HEADERS), None
+            except OxfordError as e:
+                return None, e
+
+        def attached(face, result):
+            resp, error = result
+            if error is None and resp.status_code == 200:
+                journal.write('face', personId=face[0], faceId=face[1])
+            else:
+                failed.append((face[1], str(error) if error is not None else error_message(resp)))
+
+        faces = [(journal.persons[person], faceid) for person in people if person in journal.persons
+                 for faceid in faceids(person) if (journal.persons[person], faceid) not in journal.faces]
+        run_batch(faces, attach, attached, concurrency)
+
+        if train and not journal.trained:
+            resp = client.post('face', '/persongroups/%s/training' % persongroupid)
+            if resp.status_code < 300:
+                journal.write('train', personGroupId=persongroupid)
+            else:
+                failed.append((persongroupid, error_message(resp)))
+    finally:
+        journal.close()
+
+    for item, message in failed:
+        click.echo('%s: %s' % (item, message), err=True)
+    print "Imported %d people with %d faces into PersonGroup %s" % (len(journal.persons), len(journal.faces), persongroupid)
+    if failed:
+        ctx.exit(1)
 
 #
 # Person sub command
 #
-@click.group()
+@click.group(cls=LazyGroup)
 @click.pass_context
 def person(ctx):
     pass
@@ -334,48 +3086,27 @@ def person(ctx):
 @click.argument('name')
 @click.pass_context
 def create_person(ctx, faceid, persongroupid, customdata, name):
-    person_create_url = ctx.obj['oxford_url'] + '/persongroups/%s/persons' % persongroupid
-    params = dict()
-    headers = {
-    'Content-Type' : 'application/json',
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
     payload = json.dumps({
         'name' : name,
         'userData' : customdata or "Created %s" % str(datetime.datetime.now()),
         'faceIds' : [faceid]
         })
-    print payload
-    print params
-    print headers
-    print person_create_url
-    try:
-        resp = requests.post(person_create_url, data=payload, params=params, headers=headers, verify=False)
-        print resp
-        if resp.status_code == 200:
-            print "Created Person with id %s" % resp.json()['personId']
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+    resp = ctx.obj['client'].post('face', '/persongroups/%s/persons' % persongroupid, data=payload, headers=JSON_HEADERS)
+    if resp.status_code == 200:
+        print "Created Person with id %s" % resp.json()['personId']
+    else:
+        print error_message(resp)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--persongroupid', required=True, help='The ID of the PersonGroup this person belongs to.')
+@click.option('--local', is_flag=True, help='Answer from the local mirror.')
 @click.argument('personid', required=True)
 @click.pass_context
-def retrieve_person(ctx, persongroupid, personid):
-    person_get_url = ctx.obj['oxford_url'] + '/persongroups/%s/persons/%s' % (persongroupid, personid)
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    try:
-        resp = requests.get(person_get_url, params=None, headers=headers)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+def retrieve_person(ctx, persongroupid, local, personid):
+    if local:
+        return echo_local(open_mirror(ctx).person(persongroupid, personid), "Person %s" % personid)
+    resp = ctx.obj['client'].get('face', '/persongroups/%s/persons/%s' % (persongroupid, personid))
+    echo_response(resp)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--name', default='', help='User-provided name.')
@@ -385,47 +3116,26 @@ def retrieve_person(ctx, persongroupid, personid):
 @click.argument('personid')
 @click.pass_context
 def update_person(ctx, name, faceid, persongroupid, customdata, personid):
-    person_update_url = ctx.obj['oxford_url'] + '/persongroups/%s/persons/%s' % (persongroupid, personid)
-    params = dict()
-    headers = {
-    'Content-Type' : 'application/json',
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
     payload = json.dumps({
         'name' : name,
         'userData' : customdata or "Updated at %s" % str(datetime.datetime.now()),
         'faceIds' : [faceid]
         })
-    try:
-        resp = requests.patch(person_update_url, data=payload, params=params, headers=headers, verify=False)
-        print resp
-        if resp.status_code != 200:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+    resp = ctx.obj['client'].patch('face', '/persongroups/%s/persons/%s' % (persongroupid, personid), data=payload, headers=JSON_HEADERS)
+    echo_error(resp)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--persongroupid', required=True, help='The ID of the PersonGroup this person belongs to.')
 @click.argument('personid', required=True)
 @click.pass_context
 def delete_person(ctx, persongroupid, personid):
-    person_get_url = ctx.obj['oxford_url'] + '/persongroups/%s/persons/%s' % (persongroupid, personid)
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    try:
-        resp = requests.delete(person_get_url, params=None, headers=headers)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
-        
+    resp = ctx.obj['client'].delete('face', '/persongroups/%s/persons/%s' % (persongroupid, personid))
+    echo_error(resp)
+
 #
 # PersonFace sub command
 #
-@click.group()
+@click.group(cls=LazyGroup)
 @click.pass_context
 def personface(ctx):
     pass
@@ -437,24 +3147,14 @@ def personface(ctx):
 @click.option('--customdata', default=None, help='User-provided data attached to the person group. The size limit is 16KB.')
 @click.pass_context
 def add_personface(ctx, persongroupid, personid, faceid, customdata):
-    person_create_url = ctx.obj['oxford_url'] + '/persongroups/%s/persons/%s/faces/%s' % (persongroupid, personid, faceid)
-    params = dict()
-    headers = {
-    'Content-Type' : 'application/json',
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
     payload = json.dumps({
         'userData' : customdata or "Created %s" % str(datetime.datetime.now())
         })
-    try:
-        resp = requests.put(person_create_url, data=payload, params=params, headers=headers, verify=False)
-        print resp
-        if resp.status_code == 200:
-            print "Created Person with id %s" % resp.json()['personId']
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+    resp = ctx.obj['client'].put('face', '/persongroups/%s/persons/%s/faces/%s' % (persongroupid, personid, faceid), data=payload, headers=JSON_HEADERS)
+    if resp.status_code == 200:
+        print "Added face %s to person %s" % (faceid, personid)
+    else:
+        print error_message(resp)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--persongroupid', required=True, help='The ID of the PersonGroup this person belongs to.')
@@ -462,18 +3162,8 @@ def add_personface(ctx, persongroupid, personid, faceid, customdata):
 @click.option('--faceid', required=True, help='At least one faceid for the person.')
 @click.pass_context
 def retrieve_personface(ctx, persongroupid, personid, faceid):
-    person_get_url = ctx.obj['oxford_url'] + '/persongroups/%s/persons/%s/faces/%s' % (persongroupid, personid, faceid)
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    try:
-        resp = requests.get(person_get_url, params=None, headers=headers)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+    resp = ctx.obj['client'].get('face', '/persongroups/%s/persons/%s/faces/%s' % (persongroupid, personid, faceid))
+    echo_response(resp)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--persongroupid', required=True, help='The ID of the PersonGroup this person belongs to.')
@@ -482,23 +3172,12 @@ def retrieve_personface(ctx, persongroupid, personid, faceid):
 @click.option('--customdata', default=None, help='User-provided data attached to the person group. The size limit is 16KB.')
 @click.pass_context
 def update_personface(ctx, persongroupid, personid, faceid, customdata):
-    person_update_url = ctx.obj['oxford_url'] + '/persongroups/%s/persons/%s/faces/%s' % (persongroupid, personid, faceid)
-    params = dict()
-    headers = {
-    'Content-Type' : 'application/json',
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
     payload = json.dumps({
         'userData' : customdata or "Updated at %s" % str(datetime.datetime.now()),
         'faceIds' : [faceid]
         })
-    try:
-        resp = requests.patch(person_update_url, data=payload, params=params, headers=headers, verify=False)
-        print resp
-        if resp.status_code != 200:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+    resp = ctx.obj['client'].patch('face', '/persongroups/%s/persons/%s/faces/%s' % (persongroupid, personid, faceid), data=payload, headers=JSON_HEADERS)
+    echo_error(resp)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--persongroupid', required=True, help='The ID of the PersonGroup this person belongs to.')
@@ -506,100 +3185,265 @@ def update_personface(ctx, persongroupid, personid, faceid, customdata):
 @click.option('--faceid', required=True, help='At least one faceid for the person.')
 @click.pass_context
 def delete_personface(ctx, persongroupid, personid, faceid):
-    person_delete_url = ctx.obj['oxford_url'] + '/persongroups/%s/persons/%s/faces/%s' % (persongroupid, personid, faceid)
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['face']
-    }
-    try:
-        resp = requests.delete(person_delete_url, params=None, headers=headers)
-        if resp.status_code != 200:
-            print resp.json()['message']
-    except Exception as e:
-        print e
-   
+    resp = ctx.obj['client'].delete('face', '/persongroups/%s/persons/%s/faces/%s' % (persongroupid, personid, faceid))
+    echo_error(resp)
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('faceid', required=True)
+@click.pass_context
+def personface_owner(ctx, faceid):
+    """Find the persons a faceId is enrolled under, from the local mirror."""
+    echo_json(open_mirror(ctx).owners(faceid))
+
 #
 # Vision commands
 #
-@click.group()
+@click.group(cls=LazyGroup)
 @click.option('--apikey', envvar='OXFORD_VISION_APIKEY', default=None, help='Your API Key from http://https://dev.projectoxford.ai/.')
 @click.pass_context
 def vision(ctx, apikey):
     if apikey:
         ctx.obj['apikeys']['vision'] = apikey
-    ctx.obj['oxford_url'] += 'vision/v1'
+        ctx.obj['pools'].pop('vision', None)
 
 @click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--pool', is_flag=True, help='Add the key to the pool of vision keys requests are spread over.')
+@click.option('--endpoint', default=None, help='The endpoint the pooled key is for, instead of --oxford-url.')
 @click.argument('apikey')
 @click.pass_context
-def vision_api_key(ctx, apikey):
-    config = load_config(CONFIG_FILE)
-    config['vision'] = apikey
-    save_config(CONFIG_FILE, config)
-    
-# use vision api to analyze an image         
+def vision_api_key(ctx, pool, endpoint, apikey):
+    save_api_key('vision', apikey, pool, endpoint)
+
+# use vision api to analyze an image
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--features', default=True, help='Optional parameter to get face landmarks.')
+@click.option('--max-dimension', default=None, type=int, help='Shrink local images to at most this many pixels a side before upload.')
+@click.option('--max-bytes', default=None, type=int, help='Re-encode local images to at most this many bytes before upload.')
 @click.argument('image_path', callback=resolve_input)
 @click.pass_context
-def analyze_image(ctx, features, image_path):
+def analyze_image(ctx, features, max_dimension, max_bytes, image_path):
     """Analyze an image with Oxford."""
-    vision_analysis_url = ctx.obj['oxford_url'] + '/analyses'
-    params = {
-    }
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['vision']
-    }
-    if type(image_path) is file:
-        headers['Content-type'] = 'application/octet-stream'
-        payload = image_path.read()
-    if type(image_path) is urlparse.ParseResult:
-        headers['Content-type'] = 'application/json'
-        payload = json.dumps({ 'Url' : image_path.geturl() })
+    shrink = make_shrinker(max_dimension, max_bytes)
+    resp = post_image(ctx, 'vision', '/analyses', image_path, url_key='Url', shrink=shrink)
+    echo_response(resp)
+
+# analyze many images, one json result per line
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight.')
+@click.option('--engine', default='thread', type=click.Choice(['thread', 'async']), help='Run requests on a thread pool, or on an event loop (needs tornado).')
+@click.option('--max-dimension', default=None, type=int, help='Shrink local images to at most this many pixels a side before upload.')
+@click.option('--max-bytes', default=None, type=int, help='Re-encode local images to at most this many bytes before upload.')
+@click.option('--store', default=None, type=LocalPath(file_okay=False), help='Also save the results as NumPy arrays in this directory, for oxford report (needs numpy).')
+@click.option('--journal', default=None, type=LocalPath(dir_okay=False), help='Record the progress of each image in this SQLite file.')
+@click.option('--resume', is_flag=True, help='Skip the images the journal has done or failed.')
+@click.option('--retry-failed', is_flag=True, help='Skip the images the journal has done, run the failed ones again.')
+@click.option('--shard', default=None, callback=parse_shard, help='Only run the images in shard i of N, e.g. 0/4.')
+@click.argument('sources', nargs=-1, required=True)
+@click.pass_context
+def analyze_batch(ctx, concurrency, engine, max_dimension, max_bytes, store, journal, resume, retry_failed, shard, sources):
+    """Analyze a directory, glob or manifest of images ('-' reads the manifest from stdin)."""
+    job = BatchJob(ctx, journal, resume, retry_failed, shard)
+    store = open_store(store, 'analysis')
+    shrink = make_shrinker(max_dimension, max_bytes, processes=multiprocessing.cpu_count())
+
+    def done(image, resp, error):
+        record = batch_record(image, resp, error, 'analysis')
+        if store:
+            store.add(record)
+        job.finished(image, record)
+        echo_line(record)
+
     try:
-        resp = requests.post(vision_analysis_url, params=params, data=payload, headers=headers)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
-        else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
+        post_images(ctx, job.images(expand_sources(sources)), 'vision', '/analyses', done, url_key='Url',
+                    concurrency=concurrency, engine=engine, shrink=shrink)
+    finally:
+        if shrink:
+            shrink.close()
+        if store:
+            store.close()
+        job.close()
 
-# use vision api to make a thumbnail         
+# use vision api to make a thumbnail
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--width', default=50, required=True, help='Width of thumbnail to create.')
 @click.option('--height', default=50, required=True, help='Height of thumbnail to create.')
 @click.option('--smartcrop/--no-smartcrop', default=True, help='Do smart cropping.')
-@click.option('--thumbnail', default='thumbnail.jpg', help='Resulting thumbnail filename.')
+@click.option('--thumbnail', default='thumbnail.jpg', type=LocalPath(dir_okay=False), help='Resulting thumbnail filename.')
 @click.argument('image_path', callback=resolve_input)
 @click.pass_context
 def thumbnail(ctx, width, height, smartcrop, thumbnail, image_path):
     """Analyze an image with Oxford."""
-    thumbnail_analysis_url = ctx.obj['oxford_url'] + '/thumbnails'
     params = {
         'width' : width,
         'height' : height,
         'smartCropping' : smartcrop
     }
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['vision']
-    }
-    if type(image_path) is file:
-        headers['Content-type'] = 'application/octet-stream'
-        payload = image_path.read()
-    if type(image_path) is urlparse.ParseResult:
-        headers['Content-type'] = 'application/json'
-        payload = json.dumps({ 'Url' : image_path.geturl() })
+    headers = {}
+    payload = image_payload(image_path, headers, url_key='Url')
+    resp = ctx.obj['client'].post('vision', '/thumbnails', params=params, data=payload, headers=headers, stream=True)
+    if resp.status_code == 200:
+        with open(thumbnail, 'wb') as out_file:
+            shutil.copyfileobj(resp.raw, out_file)
+    else:
+        print error_message(resp)
+
+# One image's upload body, shared by every thumbnail size made from it. A
+# local file is mapped into memory once and each request sends a read-only
+# view of the mapping, so no size copies the image; a url is its json.
+class SharedImage(object):
+
+    def __init__(self, image):
+        self.mapping = None
+        if image.startswith('http'):
+            self.content_type = 'application/json'
+            self.data = json.dumps({ 'Url' : image })
+            return
+        self.content_type = 'application/octet-stream'
+        with open(local_path(image), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.mapping = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else None
+        self.data = buffer(self.mapping) if self.mapping else ''
+
+    def close(self):
+        if self.mapping:
+            self.data = None
+            self.mapping.close()
+
+# a thumbnail size, e.g. 100x100
+def parse_sizes(ctx, param, value):
+    sizes = []
+    for size in value:
+        match = re.match(r'^(\d+)x(\d+)$', size)
+        if not match:
+            raise click.BadParameter('sizes are WIDTHxHEIGHT, e.g. 100x100, not %s' % size)
+        sizes.append((int(match.group(1)), int(match.group(2))))
+    return sizes
+
+# where an image's thumbnail of one size goes, from the output template
+def thumbnail_path(template, image, width, height):
+    if image.startswith('http'):
+        directory, name = '', os.path.basename(urlparse.urlparse(image).path) or 'image'
+    else:
+        directory, name = os.path.split(image)
+    stem, ext = os.path.splitext(name)
+    return template.format(dir=directory or '.', name=name, stem=stem, ext=ext, width=width, height=height)
+
+# a thumbnail that's there already and newer than its image (a url is never newer)
+def up_to_date(path, image):
     try:
-        resp = requests.post(thumbnail_analysis_url, params=params, data=payload, headers=headers, stream=True)
-        if resp.status_code == 200:
-            with open(thumbnail, 'wb') as out_file:
-                shutil.copyfileobj(resp.raw, out_file)
+        made = os.path.getmtime(local_path(path))
+    except OSError:
+        return False
+    return image.startswith('http') or made >= os.path.getmtime(local_path(image))
+
+# open the file a thumbnail is written to beside its path, renamed into place
+# when done as a half written thumbnail would look up to date
+def thumbnail_file(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # another size got there first
+            if e.errno != errno.EEXIST:
+                raise
+    return open('%s.%s.tmp' % (path, uuid.uuid4().hex), 'w+b')
+
+# post one thumbnail size, streaming the response straight to its file
+def make_thumbnail(client, source, params, path):
+    headers = { 'Content-type' : source.content_type }
+    resp = client.post('vision', '/thumbnails', params=params, data=source.data, headers=headers, stream=True)
+    try:
+        if resp.status_code != 200:
+            return resp.status_code, error_message(resp), 0
+        f = thumbnail_file(path)
+        try:
+            with f:
+                shutil.copyfileobj(resp.raw, f, 64 * 1024)
+                written = f.tell()
+            os.rename(f.name, path)
+        except Exception:
+            # a response cut short leaves nothing behind
+            os.unlink(f.name)
+            raise
+        return resp.status_code, None, written
+    finally:
+        resp.close()
+
+# make several thumbnail sizes of many images
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--size', 'sizes', multiple=True, required=True, callback=parse_sizes, help='A thumbnail size, WIDTHxHEIGHT, give it once for each size.')
+@click.option('--smartcrop/--no-smartcrop', default=True, help='Do smart cropping.')
+@click.option('--output', 'template', default='thumbnails/{width}x{height}/{stem}.jpg', help='Where thumbnails go, using {dir}, {name}, {stem}, {ext}, {width} and {height} of each image and size.')
+@click.option('--force', is_flag=True, help='Remake thumbnails that are newer than their image.')
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight.')
+@click.option('--engine', default='thread', type=click.Choice(['thread', 'async']), help='Run requests on a thread pool, or on an event loop (needs tornado).')
+@click.argument('sources', nargs=-1, required=True)
+@click.pass_context
+def thumbnail_batch(ctx, sizes, smartcrop, template, force, concurrency, engine, sources):
+    """Make thumbnails of a directory, glob or manifest of images ('-' reads the manifest from stdin)."""
+    try:
+        thumbnail_path(template, 'image.jpg', 1, 1)
+    except (KeyError, IndexError, ValueError) as e:
+        raise click.BadParameter('unknown field %s in --output' % e)
+    client = ctx.obj['client']
+    # the shared source of each image with thumbnails in flight, and how many
+    open_images = {}
+
+    def tasks():
+        for image in expand_sources(sources):
+            todo = []
+            for width, height in sizes:
+                path = thumbnail_path(template, image, width, height)
+                if not force and up_to_date(path, image):
+                    echo_line({ 'image' : image, 'thumbnail' : path, 'skipped' : True })
+                else:
+                    todo.append((width, height, path))
+            if not todo:
+                continue
+            try:
+                open_images[image] = [SharedImage(image), len(todo)]
+            except (IOError, OSError, ValueError) as e:
+                echo_line({ 'image' : image, 'error' : str(e) })
+                continue
+            for width, height, path in todo:
+                yield image, width, height, path
+
+    def params(width, height):
+        return { 'width' : width, 'height' : height, 'smartCropping' : smartcrop }
+
+    def work(task):
+        image, width, height, path = task
+        try:
+            return make_thumbnail(client, open_images[image][0], params(width, height), local_path(path)), None
+        except Exception as e:
+            return None, e
+
+    def done(task, outcome, error):
+        image, width, height, path = task
+        record = { 'image' : image, 'thumbnail' : path, 'width' : width, 'height' : height }
+        if error is not None:
+            record['error'] = str(error)
         else:
-            print resp.json()['message']
-    except Exception as e:
-        print e
-   
-# use vision api to recognize text in an image         
+            record['status'], message, record['bytes'] = outcome
+            if message:
+                record['error'] = message
+        echo_line(record)
+        open_images[image][1] -= 1
+        if not open_images[image][1]:
+            open_images.pop(image)[0].close()
+
+    if engine == 'async':
+        # urls are streamed to their files on the loop, local files go to threads
+        engine = AsyncEngine(ctx, concurrency)
+        def start(task):
+            image, width, height, path = task
+            return engine.thumbnail(image, open_images[image][0], params(width, height), local_path(path))
+        engine.run(tasks(), start, done)
+    else:
+        run_batch(tasks(), work, lambda task, result: done(task, *result), concurrency)
+
+# use vision api to recognize text in an image
 @click.command(context_settings=CONTEXT_SETTINGS)
 @click.option('--language', default='unk', help='Language encoding in the image.')
 @click.option('--detect-orientation/--no-detect-orientation', default=True, help='Detect the text orientation automatically.')
@@ -607,72 +3451,1216 @@ def thumbnail(ctx, width, height, smartcrop, thumbnail, image_path):
 @click.pass_context
 def ocr(ctx, language, detect_orientation, image_path):
     """Analyze an image with Oxford."""
-    thumbnail_analysis_url = ctx.obj['oxford_url'] + '/ocr'
     params = {
         'language' : language,
         'detectOrientation' : detect_orientation
     }
-    headers = {
-    'Ocp-Apim-Subscription-Key' : ctx.obj['apikeys']['vision']
+    resp = post_image(ctx, 'vision', '/ocr', image_path, params=params, url_key='Url')
+    echo_response(resp)
+
+# ocr results flattened to lines of text, each with its bounding box and
+# words, and the text of every line in a full-text index
+class OcrIndex(object):
+
+    SCHEMA = """
+    create table if not exists images (
+        image text primary key, mtime real, size integer, language text,
+        orientation text, textAngle real, indexedAt real);
+    create table if not exists lines (
+        id integer primary key, image text, region integer, line integer,
+        boundingBox text, words text);
+    create index if not exists lines_by_image on lines (image);
+    create virtual table if not exists line_text using fts4(text);
+    """
+
+    def __init__(self, fname):
+        directory = os.path.dirname(fname)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(fname)
+        self.db.executescript(self.SCHEMA)
+
+    # the modification time and size of a local image, urls have neither
+    def stamp(self, image):
+        if image.startswith('http'):
+            return None, None
+        stat = os.stat(local_path(image))
+        return stat.st_mtime, stat.st_size
+
+    # an image indexed as it is now
+    def indexed(self, image):
+        row = self.db.execute('select mtime, size from images where image = ?', (image,)).fetchone()
+        return row is not None and tuple(row) == self.stamp(image)
+
+    # replace an image's lines with those of its ocr result
+    def add(self, image, result):
+        mtime, size = self.stamp(image)
+        self.remove(image)
+        lines = 0
+        for r, region in enumerate(result.get('regions', [])):
+            for l, line in enumerate(region.get('lines', [])):
+                words = line.get('words', [])
+                cursor = self.db.execute('insert into lines (image, region, line, boundingBox, words) values (?, ?, ?, ?, ?)',
+                                         (image, r, l, line.get('boundingBox'), json.dumps(words)))
+                self.db.execute('insert into line_text (docid, text) values (?, ?)',
+                                (cursor.lastrowid, ' '.join(word.get('text', '') for word in words)))
+                lines += 1
+        self.db.execute('insert into images values (?, ?, ?, ?, ?, ?, ?)',
+                        (image, mtime, size, result.get('language'), result.get('orientation'),
+                         result.get('textAngle'), time.time()))
+        return lines
+
+    def remove(self, image):
+        self.db.execute('delete from line_text where docid in (select id from lines where image = ?)', (image,))
+        self.db.execute('delete from lines where image = ?', (image,))
+        self.db.execute('delete from images where image = ?', (image,))
+
+    def commit(self):
+        self.db.commit()
+
+    # the lines matching a full-text query, e.g. 'invoice NEAR total' or 'proj*'
+    def search(self, query, limit):
+        return [{ 'image' : image, 'region' : region, 'line' : line, 'boundingBox' : box, 'text' : snippet }
+                for image, region, line, box, snippet in self.db.execute(
+                    'select lines.image, lines.region, lines.line, lines.boundingBox, '
+                    'snippet(line_text, \'[\', \']\', \'...\') from line_text join lines on lines.id = line_text.docid '
+                    'where line_text match ? order by lines.image, lines.region, lines.line limit ?', (query, limit))]
+
+    def close(self):
+        self.db.close()
+
+# the most seconds of indexed results held in a transaction
+OCR_COMMIT_INTERVAL = 1.0
+
+# ocr many images into the full-text index
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--language', default='unk', help='Language encoding in the images.')
+@click.option('--detect-orientation/--no-detect-orientation', default=True, help='Detect the text orientation automatically.')
+@click.option('--index', default=OCR_INDEX, type=LocalPath(dir_okay=False), help='The full-text index to add the text to.')
+@click.option('--reindex', is_flag=True, help='OCR images that are indexed already.')
+@click.option('--concurrency', default=8, type=click.IntRange(1, None), help='Number of requests to keep in flight.')
+@click.option('--engine', default='thread', type=click.Choice(['thread', 'async']), help='Run requests on a thread pool, or on an event loop (needs tornado).')
+@click.option('--journal', default=None, type=LocalPath(dir_okay=False), help='Record the progress of each image in this SQLite file.')
+@click.option('--resume', is_flag=True, help='Skip the images the journal has done or failed.')
+@click.option('--retry-failed', is_flag=True, help='Skip the images the journal has done, run the failed ones again.')
+@click.option('--shard', default=None, callback=parse_shard, help='Only run the images in shard i of N, e.g. 0/4.')
+@click.argument('sources', nargs=-1, required=True)
+@click.pass_context
+def ocr_batch(ctx, language, detect_orientation, index, reindex, concurrency, engine, journal, resume, retry_failed, shard, sources):
+    """OCR a directory, glob or manifest of images into a searchable index ('-' reads the manifest from stdin)."""
+    params = {
+        'language' : language,
+        'detectOrientation' : detect_orientation
     }
-    if type(image_path) is file:
-        headers['Content-type'] = 'application/octet-stream'
-        payload = image_path.read()
-    if type(image_path) is urlparse.ParseResult:
-        headers['Content-type'] = 'application/json'
-        payload = json.dumps({ 'Url' : image_path.geturl() })
-    try:
-        resp = requests.post(thumbnail_analysis_url, params=params, data=payload, headers=headers, stream=True)
-        if resp.status_code == 200:
-            print json.dumps(resp.json(), sort_keys=True, indent=2, separators=(',', ': '))
+    job = BatchJob(ctx, journal, resume, retry_failed, shard)
+    db = OcrIndex(index)
+    committed = [time.time()]
+
+    def images():
+        for image in job.images(expand_sources(sources)):
+            if not reindex and db.indexed(image):
+                record = { 'image' : image, 'skipped' : True }
+                job.finished(image, record)
+                echo_line(record)
+            else:
+                yield image
+
+    def done(image, resp, error):
+        if error is None and resp.status_code == 200:
+            record = { 'image' : image, 'status' : resp.status_code, 'lines' : db.add(image, response_json(resp)) }
+            # a commit every so often, an interrupted batch keeps most of its work
+            if time.time() - committed[0] > OCR_COMMIT_INTERVAL:
+                db.commit()
+                committed[0] = time.time()
         else:
-            print resp.json()['message']
+            record = batch_record(image, resp, error, 'ocr')
+        job.finished(image, record)
+        echo_line(record)
+
+    try:
+        post_images(ctx, images(), 'vision', '/ocr', done, params=params, url_key='Url',
+                    concurrency=concurrency, engine=engine)
+    finally:
+        db.commit()
+        db.close()
+        job.close()
+
+# search the full-text index of ocr-batch
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--index', default=OCR_INDEX, type=LocalPath(dir_okay=False), help='The full-text index to search.')
+@click.option('--limit', default=50, help='Most matching lines to show.')
+@click.argument('query')
+def ocr_search(index, limit, query):
+    """Find lines of text, e.g. 'invoice total', '"exact phrase"' or 'proj*'."""
+    if not os.path.exists(index):
+        raise click.UsageError('No index at %s, run vision ocr-batch first.' % index)
+    db = OcrIndex(index)
+    try:
+        echo_json(db.search(query, limit))
+    except sqlite3.OperationalError as e:
+        raise click.BadParameter('%s in %s' % (e, query))
+    finally:
+        db.close()
+
+#
+# Cache commands
+#
+@click.group(cls=LazyGroup)
+@click.pass_context
+def cache(ctx):
+    pass
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.pass_context
+def cache_stats(ctx):
+    """Show the size and age of the result cache."""
+    echo_json(ctx.obj['cache'].stats())
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--expired', is_flag=True, help='Only remove entries older than the cache ttl.')
+@click.pass_context
+def cache_purge(ctx, expired):
+    """Remove results from the result cache."""
+    print "Removed %d cached results" % ctx.obj['cache'].purge(expired_only=expired)
+
+#
+# Result store: detect-batch and analyze-batch results kept as NumPy
+# structured arrays, a chunk file at a time, so reports read columns of
+# numbers instead of parsing json
+#
+
+# the most rows held in memory before they're written out as a chunk
+STORE_CHUNK = 50000
+
+# the columns of a face, after the image it's in
+FACE_COLUMNS = [
+    ('faceId', 'S36'),
+    ('left', 'i4'), ('top', 'i4'), ('width', 'i4'), ('height', 'i4'),
+    ('age', 'f4'), ('gender', 'S6'),
+    ('roll', 'f4'), ('yaw', 'f4'), ('pitch', 'f4'),
+]
+
+# the columns of an analysis, after the image it's of
+ANALYSIS_COLUMNS = [
+    ('width', 'i4'), ('height', 'i4'), ('format', 'S8'),
+    ('category', 'S32'), ('categoryScore', 'f4'),
+    ('isAdult', '?'), ('adultScore', 'f4'), ('isRacy', '?'), ('racyScore', 'f4'),
+    ('foreground', 'S16'), ('background', 'S16'), ('accent', 'S6'), ('isBW', '?'),
+    ('faces', 'i2'), ('clipArt', 'i1'), ('lineDrawing', 'i1'),
+]
+
+# missing numbers are nan, so they drop out of means and histograms
+def number(value):
+    return float('nan') if value is None else value
+
+def face_rows(faces):
+    for face in faces:
+        rectangle = face.get('faceRectangle', {})
+        attributes = face.get('attributes', {})
+        pose = attributes.get('headPose', {})
+        yield (face.get('faceId', ''),
+               rectangle.get('left', -1), rectangle.get('top', -1), rectangle.get('width', -1), rectangle.get('height', -1),
+               number(attributes.get('age')), attributes.get('gender', '').lower(),
+               number(pose.get('roll')), number(pose.get('yaw')), number(pose.get('pitch')))
+
+def analysis_rows(analysis):
+    metadata = analysis.get('metadata', {})
+    categories = sorted(analysis.get('categories', []), key=lambda category: -category.get('score', 0))
+    category = categories[0] if categories else {}
+    adult = analysis.get('adult', {})
+    color = analysis.get('color', {})
+    image_type = analysis.get('imageType', {})
+    yield (metadata.get('width', -1), metadata.get('height', -1), metadata.get('format', ''),
+           category.get('name', ''), number(category.get('score')),
+           adult.get('isAdultContent', False), number(adult.get('adultScore')),
+           adult.get('isRacyContent', False), number(adult.get('racyScore')),
+           color.get('dominantColorForeground', ''), color.get('dominantColorBackground', ''),
+           color.get('accentColor', ''), color.get('isBWImg', False),
+           len(analysis.get('faces', [])), image_type.get('clipArtType', -1), image_type.get('lineDrawingType', -1))
+
+# the kinds of result a store holds, named as in batch records
+STORE_KINDS = {
+    'faces' : (FACE_COLUMNS, face_rows),
+    'analysis' : (ANALYSIS_COLUMNS, analysis_rows),
+}
+
+# One batch run's results of one kind. Rows are buffered and written as
+# <kind>-<started>-<pid>-<n>.npy chunks, each renamed into place once it's
+# complete, so concurrent runs can share a store and a run that dies loses
+# at most the rows it hadn't written yet.
+class ResultStore(object):
+
+    def __init__(self, directory, kind):
+        self.numpy = load_numpy('--store')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.kind = kind
+        self.columns, self.rows_of = STORE_KINDS[kind]
+        self.prefix = '%s-%s-%d' % (kind, time.strftime('%Y%m%d%H%M%S'), os.getpid())
+        self.chunks = 0
+        self.rows = []
+
+    # keep the result of a batch record, if it has one
+    def add(self, record):
+        result = record.get(self.kind)
+        if result is None:
+            return
+        if isinstance(result, RawJSON):
+            result = loads(result)
+        image = record['image']
+        if isinstance(image, unicode):
+            image = image.encode('utf-8')
+        self.rows.extend((image,) + row for row in self.rows_of(result))
+        if len(self.rows) >= STORE_CHUNK:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        width = max(len(row[0]) for row in self.rows)
+        chunk = self.numpy.array(self.rows, dtype=[('image', 'S%d' % max(1, width))] + self.columns)
+        path = os.path.join(self.directory, '%s-%04d.npy' % (self.prefix, self.chunks))
+        with open(path + '.tmp', 'wb') as f:
+            self.numpy.save(f, chunk)
+        os.rename(path + '.tmp', path)
+        self.chunks += 1
+        self.rows = []
+
+    close = flush
+
+# a store for a batch command's --store option, if it was given one
+def open_store(directory, kind):
+    return ResultStore(directory, kind) if directory else None
+
+# every chunk of one kind in a store, memory mapped rather than read
+def store_chunks(numpy, directory, kind):
+    for path in sorted(glob.glob(os.path.join(directory, kind + '-*.npy'))):
+        yield numpy.load(path, mmap_mode='r')
+
+# The count, mean, extremes and optionally a histogram of a column of
+# numbers, added to a chunk at a time. Values outside the histogram's edges
+# are counted in its first or last bar.
+class ColumnStats(object):
+
+    def __init__(self, numpy, edges=None):
+        self.numpy = numpy
+        self.edges = edges
+        self.bars = numpy.zeros(len(edges) - 1, dtype=numpy.int64) if edges is not None else None
+        self.count = 0
+        self.total = 0.0
+        self.low = float('inf')
+        self.high = float('-inf')
+
+    def add(self, values):
+        numpy = self.numpy
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values[~numpy.isnan(values)]
+        if not len(values):
+            return
+        self.count += len(values)
+        self.total += values.sum()
+        self.low = min(self.low, values.min())
+        self.high = max(self.high, values.max())
+        if self.edges is not None:
+            self.bars += numpy.histogram(numpy.clip(values, self.edges[0], self.edges[-1]), bins=self.edges)[0]
+
+    def summary(self):
+        if not self.count:
+            return { 'count' : 0 }
+        summary = { 'count' : self.count, 'mean' : self.total / self.count, 'min' : float(self.low), 'max' : float(self.high) }
+        if self.edges is not None:
+            summary['histogram'] = [{ 'from' : float(low), 'to' : float(high), 'count' : int(count) }
+                                    for low, high, count in zip(self.edges[:-1], self.edges[1:], self.bars)]
+        return summary
+
+# add the occurrences of each value in a column to counts
+def count_values(numpy, counts, values):
+    names, occurrences = numpy.unique(values, return_counts=True)
+    for name, occurrence in zip(names, occurrences):
+        counts[name or 'unknown'] += int(occurrence)
+
+def faces_report(numpy, directory, age_bin):
+    images = set()
+    ages = ColumnStats(numpy, numpy.arange(0, 100 + age_bin, age_bin))
+    sizes = ColumnStats(numpy)
+    poses = dict((name, ColumnStats(numpy)) for name in ('roll', 'yaw', 'pitch'))
+    genders = collections.Counter()
+    faces = 0
+    for chunk in store_chunks(numpy, directory, 'faces'):
+        faces += len(chunk)
+        images.update(numpy.unique(chunk['image']).tolist())
+        ages.add(chunk['age'])
+        sizes.add(chunk['width'])
+        for name, stats in poses.items():
+            stats.add(chunk[name])
+        count_values(numpy, genders, chunk['gender'])
+    if not faces:
+        return None
+    return {
+        'faces' : faces,
+        'images' : len(images),
+        'age' : ages.summary(),
+        'gender' : dict(genders),
+        'faceWidth' : sizes.summary(),
+        'headPose' : dict((name, stats.summary()) for name, stats in poses.items()),
+    }
+
+def analysis_report(numpy, directory, bins):
+    edges = numpy.linspace(0.0, 1.0, bins + 1)
+    adult, racy = ColumnStats(numpy, edges), ColumnStats(numpy, edges)
+    faces = ColumnStats(numpy)
+    categories, foregrounds, backgrounds = collections.Counter(), collections.Counter(), collections.Counter()
+    flags = collections.Counter()
+    analyses = 0
+    for chunk in store_chunks(numpy, directory, 'analysis'):
+        analyses += len(chunk)
+        adult.add(chunk['adultScore'])
+        racy.add(chunk['racyScore'])
+        faces.add(chunk['faces'])
+        count_values(numpy, categories, chunk['category'])
+        count_values(numpy, foregrounds, chunk['foreground'])
+        count_values(numpy, backgrounds, chunk['background'])
+        for name in ('isAdult', 'isRacy', 'isBW'):
+            flags[name] += int(numpy.count_nonzero(chunk[name]))
+    if not analyses:
+        return None
+    return {
+        'images' : analyses,
+        'categories' : dict(categories),
+        'dominantColorForeground' : dict(foregrounds),
+        'dominantColorBackground' : dict(backgrounds),
+        'adultContent' : flags['isAdult'],
+        'racyContent' : flags['isRacy'],
+        'blackAndWhite' : flags['isBW'],
+        'adultScore' : adult.summary(),
+        'racyScore' : racy.summary(),
+        'faces' : faces.summary(),
+    }
+
+# summarize a result store
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--age-bin', default=10, type=click.IntRange(1, None), help='Years in each bar of the age histogram.')
+@click.option('--bins', default=10, type=click.IntRange(1, None), help='Bars in the score histograms.')
+@click.argument('store', type=LocalPath(exists=True, file_okay=False))
+def report(age_bin, bins, store):
+    """Aggregate the results detect-batch and analyze-batch saved with --store (needs numpy)."""
+    numpy = load_numpy('report')
+    summary = {}
+    faces = faces_report(numpy, store, age_bin)
+    if faces:
+        summary['faces'] = faces
+    analysis = analysis_report(numpy, store, bins)
+    if analysis:
+        summary['analysis'] = analysis
+    if not summary:
+        raise click.UsageError('No results in %s, run detect-batch or analyze-batch with --store.' % store)
+    echo_json(summary)
+
+#
+# Mock Project Oxford: an in-process stand in for the endpoints this tool
+# calls, for measuring and regression testing throughput without api quota
+#
+
+# the landmarks a mock face has, around the face rectangle's centre
+MOCK_LANDMARKS = {
+    'pupilLeft' : (-0.2, -0.15),
+    'pupilRight' : (0.2, -0.15),
+    'noseTip' : (0.0, 0.05),
+    'mouthLeft' : (-0.15, 0.25),
+    'mouthRight' : (0.15, 0.25),
+}
+
+# The mock's state and answers. Results are made up but shaped like the real
+# ones, and the same image always gets the same faces. Every request waits
+# latency seconds, give or take jitter, then fails with a 500 error_rate of
+# the time and a 429 throttle_rate of the time.
+class MockOxford(object):
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.persongroups = collections.OrderedDict()
+        self.persons = {}
+        self.training = {}
+        self.faces = {}
+        self.server = None
+
+    # serve on a background thread, returning the oxford url to use
+    def start(self, host='127.0.0.1', port=0):
+        mock = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            # one write a response, without waiting on delayed acks
+            wbufsize = -1
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def handle_request(self):
+                path, _, query = self.path.partition('?')
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else ''
+                status, headers, content = mock.handle(self.command, path, urlparse.parse_qs(query),
+                                                       self.headers, body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+                self.wfile.flush()
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        self.server = Server((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://%s:%d/' % self.server.server_address
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    # the number of requests answered so far, and start again from zero
+    def reset_count(self):
+        with self.lock:
+            count, self.requests = self.requests, 0
+        return count
+
+    # answer one request with its status, headers and body
+    def handle(self, method, path, query, headers, body):
+        with self.lock:
+            self.requests += 1
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if not headers.get('Ocp-Apim-Subscription-Key'):
+            return self.error(401, 'Unspecified', 'Access denied due to missing subscription key.')
+        chance = random.random()
+        if chance < self.throttle_rate:
+            status, headers, content = self.error(429, 'RateLimitExceeded',
+                                                  'Rate limit is exceeded. Try again in %d seconds.' % self.retry_after)
+            headers['Retry-After'] = str(self.retry_after)
+            return status, headers, content
+        if chance < self.throttle_rate + self.error_rate:
+            return self.error(500, 'InternalServerError', 'Mock internal server error.')
+        parts = path.strip('/').split('/')
+        if len(parts) < 3 or '/'.join(parts[:2]) not in SERVICES.values():
+            return self.error(404, 'ResourceNotFound', 'Resource not found.')
+        try:
+            if parts[2] == 'persongroups':
+                return self.persongroup(method, parts[3:], body)
+            answer = getattr(self, 'post_%s' % parts[2], None)
+            if method != 'POST' or len(parts) != 3 or answer is None:
+                return self.error(404, 'ResourceNotFound', 'Resource not found.')
+            return answer(query, body)
+        except (ValueError, KeyError, TypeError):
+            return self.error(400, 'BadArgument', 'Request body is invalid.')
+
+    def error(self, status, code, message):
+        return status, dict(JSON_HEADERS), json.dumps({ 'error' : { 'code' : code, 'message' : message } })
+
+    def ok(self, data, status=200):
+        return status, dict(JSON_HEADERS), json.dumps(data) if data is not None else ''
+
+    # the same made up numbers for the same image
+    def seed(self, body):
+        return random.Random(hashlib.md5(body).hexdigest())
+
+    def post_detections(self, query, body):
+        rand = self.seed(body)
+        faces = []
+        for _ in range(rand.randint(1, 3)):
+            faceid = str(uuid.UUID(int=rand.getrandbits(128)))
+            size = rand.randint(40, 200)
+            left, top = rand.randint(0, 600), rand.randint(0, 400)
+            face = { 'faceId' : faceid, 'faceRectangle' : { 'left' : left, 'top' : top, 'width' : size, 'height' : size } }
+            if query.get('analyzesFaceLandmarks') == ['true']:
+                face['faceLandmarks'] = dict((name, { 'x' : left + size * (0.5 + x), 'y' : top + size * (0.5 + y) })
+                                             for name, (x, y) in MOCK_LANDMARKS.items())
+            attributes = {}
+            if query.get('analyzesAge') == ['true']:
+                attributes['age'] = rand.randint(5, 80)
+            if query.get('analyzesGender') == ['true']:
+                attributes['gender'] = rand.choice(['male', 'female'])
+            if query.get('analyzesHeadPose') == ['true']:
+                attributes['headPose'] = { 'roll' : rand.uniform(-20, 20), 'yaw' : rand.uniform(-40, 40), 'pitch' : 0.0 }
+            face['attributes'] = attributes
+            with self.lock:
+                self.faces[faceid] = face
+            faces.append(face)
+        return self.ok(faces)
+
+    def post_identifications(self, query, body):
+        request = json.loads(body)
+        with self.lock:
+            persons = list(self.persons.get(request['personGroupId'], {}).values())
+        results = []
+        for faceid in request['faceIds']:
+            rand = self.seed(faceid)
+            count = min(len(persons), request.get('maxNumOfCandidatesReturned', 1))
+            candidates = [{ 'personId' : person['personId'], 'confidence' : rand.random() }
+                          for person in rand.sample(persons, count)]
+            results.append({ 'faceId' : faceid, 'candidates' : sorted(candidates, key=lambda c: -c['confidence']) })
+        return self.ok(results)
+
+    def post_verifications(self, query, body):
+        request = json.loads(body)
+        confidence = self.seed(request['faceId1'] + request['faceId2']).random()
+        return self.ok({ 'isIdentical' : confidence > 0.5, 'confidence' : confidence })
+
+    def post_findsimilars(self, query, body):
+        request = json.loads(body)
+        return self.ok([{ 'faceId' : faceid, 'confidence' : self.seed(faceid).random() }
+                        for faceid in request['faceIds'] if self.seed(request['faceId'] + faceid).random() > 0.7])
+
+    def post_groupings(self, query, body):
+        groups = collections.defaultdict(list)
+        for faceid in json.loads(body)['faceIds']:
+            groups[self.seed(faceid).randint(0, 9)].append(faceid)
+        return self.ok({ 'groups' : [group for group in groups.values() if len(group) > 1],
+                         'messyGroup' : [group[0] for group in groups.values() if len(group) == 1] })
+
+    def post_analyses(self, query, body):
+        rand = self.seed(body)
+        return self.ok({
+            'requestId' : str(uuid.UUID(int=rand.getrandbits(128))),
+            'metadata' : { 'width' : 800, 'height' : 600, 'format' : 'Jpeg' },
+            'categories' : [{ 'name' : rand.choice(['people_', 'outdoor_', 'others_']), 'score' : rand.random() }],
+            'adult' : { 'isAdultContent' : False, 'isRacyContent' : False, 'adultScore' : rand.random() / 10, 'racyScore' : rand.random() / 10 },
+            'faces' : [{ 'age' : rand.randint(5, 80), 'gender' : rand.choice(['Male', 'Female']),
+                         'faceRectangle' : { 'left' : 100, 'top' : 100, 'width' : 80, 'height' : 80 } }],
+            'color' : { 'dominantColorForeground' : 'Black', 'dominantColorBackground' : 'White',
+                        'dominantColors' : ['White', 'Black'], 'accentColor' : '1F4E79', 'isBWImg' : False },
+            'imageType' : { 'clipArtType' : 0, 'lineDrawingType' : 0 },
+        })
+
+    def post_thumbnails(self, query, body):
+        width, height = int(query['width'][0]), int(query['height'][0])
+        # made up bytes about the size a jpeg thumbnail would be
+        return 200, { 'Content-Type' : 'image/jpeg' }, '\xff\xd8' + os.urandom(max(64, width * height // 8)) + '\xff\xd9'
+
+    def post_ocr(self, query, body):
+        rand = self.seed(body)
+        words = ['oxford', 'project', 'vision', 'face', 'mock', 'text', 'line', 'word']
+        lines = [{ 'boundingBox' : '10,%d,200,20' % (30 * i),
+                   'words' : [{ 'boundingBox' : '%d,%d,40,20' % (10 + 50 * j, 30 * i), 'text' : rand.choice(words) } for j in range(4)] }
+                 for i in range(rand.randint(1, 5))]
+        return self.ok({ 'language' : query.get('language', ['en'])[0], 'orientation' : 'Up', 'textAngle' : 0.0,
+                         'regions' : [{ 'boundingBox' : '10,0,200,%d' % (30 * len(lines)), 'lines' : lines }] })
+
+    # /persongroups[/id[/training|/persons[/id[/faces/id]]]]
+    def persongroup(self, method, parts, body):
+        request = json.loads(body) if body else {}
+        with self.lock:
+            if not parts:
+                if method == 'GET':
+                    return self.ok(list(self.persongroups.values()))
+                return self.error(404, 'ResourceNotFound', 'Resource not found.')
+            groupid = parts[0]
+            if len(parts) == 1 and method == 'PUT':
+                if groupid in self.persongroups:
+                    return self.error(409, 'PersonGroupExists', 'Person group already exists.')
+                self.persongroups[groupid] = { 'personGroupId' : groupid, 'name' : request.get('name', ''),
+                                               'userData' : request.get('userData', '') }
+                self.persons[groupid] = collections.OrderedDict()
+                return self.ok(None)
+            if groupid not in self.persongroups:
+                return self.error(404, 'PersonGroupNotFound', 'Person group %s is not found.' % groupid)
+            persons = self.persons[groupid]
+            if len(parts) == 1:
+                if method == 'GET':
+                    return self.ok(self.persongroups[groupid])
+                if method == 'PATCH':
+                    self.persongroups[groupid].update((key, request[key]) for key in ('name', 'userData') if key in request)
+                    return self.ok(None)
+                if method == 'DELETE':
+                    del self.persongroups[groupid], self.persons[groupid]
+                    self.training.pop(groupid, None)
+                    return self.ok(None)
+            elif parts[1] == 'training' and len(parts) == 2:
+                now = datetime.datetime.utcnow().isoformat()
+                if method == 'POST':
+                    self.training[groupid] = { 'status' : 'succeeded', 'startTime' : now, 'endTime' : now }
+                    return self.ok(None, 202)
+                if method == 'GET':
+                    if groupid not in self.training:
+                        return self.error(404, 'PersonGroupNotTrained', 'Person group %s not trained.' % groupid)
+                    return self.ok(dict(self.training[groupid], lastActionDateTime=now))
+            elif parts[1] == 'persons' and len(parts) == 2:
+                if method == 'GET':
+                    return self.ok(list(persons.values()))
+                if method == 'POST':
+                    personid = str(uuid.uuid4())
+                    persons[personid] = { 'personId' : personid, 'name' : request.get('name', ''),
+                                          'userData' : request.get('userData', ''), 'faceIds' : list(request.get('faceIds', [])) }
+                    return self.ok({ 'personId' : personid })
+            elif parts[1] == 'persons':
+                person = persons.get(parts[2])
+                if person is None:
+                    return self.error(404, 'PersonNotFound', 'Person %s is not found.' % parts[2])
+                if len(parts) == 3:
+                    if method == 'GET':
+                        return self.ok(person)
+                    if method == 'PATCH':
+                        person.update((key, request[key]) for key in ('name', 'userData', 'faceIds') if key in request)
+                        return self.ok(None)
+                    if method == 'DELETE':
+                        del persons[parts[2]]
+                        return self.ok(None)
+                elif len(parts) == 5 and parts[3] == 'faces':
+                    faceid = parts[4]
+                    if method == 'PUT':
+                        if faceid not in person['faceIds']:
+                            person['faceIds'].append(faceid)
+                        return self.ok(None)
+                    if faceid not in person['faceIds']:
+                        return self.error(404, 'FaceNotFound', 'Face %s is not found.' % faceid)
+                    if method in ('GET', 'PATCH'):
+                        return self.ok({ 'faceId' : faceid, 'userData' : request.get('userData', '') })
+                    if method == 'DELETE':
+                        person['faceIds'].remove(faceid)
+                        return self.ok(None)
+        return self.error(404, 'ResourceNotFound', 'Resource not found.')
+
+# run the mock in the foreground, e.g. to point other tools at it
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--host', default='127.0.0.1', help='The address to listen on.')
+@click.option('--port', default=8765, help='The port to listen on.')
+@click.option('--latency', default=0.0, help='Seconds each request takes.')
+@click.option('--jitter', default=0.0, help='Standard deviation of the latency, in seconds.')
+@click.option('--error-rate', default=0.0, help='Fraction of requests answered 500.')
+@click.option('--throttle-rate', default=0.0, help='Fraction of requests answered 429.')
+@click.option('--retry-after', default=1, help='Seconds a 429 asks the client to wait.')
+def mock(host, port, latency, jitter, error_rate, throttle_rate, retry_after):
+    """Serve a mock Project Oxford api, use it with --oxford-url."""
+    server = MockOxford(latency, jitter, error_rate, throttle_rate, retry_after)
+    print "Mock Project Oxford at %s, any api key will do" % server.start(host, port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+#
+# Benchmarks: run commands against the mock, one process per run
+#
+
+# Per request latencies of a benchmark run. oxford bench names a file in
+# OXFORD_BENCH_LATENCIES and the client records every response's latency,
+# writing them there as the process exits.
+class LatencyLog(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.latencies = []
+        atexit.register(self.write)
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+
+    # a requests response hook
+    def hook(self, resp, *args, **kwargs):
+        self.record(resp.elapsed.total_seconds())
+
+    def write(self):
+        with open(self.path, 'w') as f:
+            f.write(''.join('%f\n' % seconds for seconds in self.latencies))
+
+latency_log = LatencyLog(os.environ['OXFORD_BENCH_LATENCIES']) if os.environ.get('OXFORD_BENCH_LATENCIES') else None
+
+# the commands oxford bench knows how to run, and their arguments given the
+# benchmark's images, faceIds, persongroupId and concurrency
+BENCHMARKS = collections.OrderedDict([
+    ('detect-batch', lambda images, faceids, groupid, concurrency:
+        ['face', 'detect-batch', '--concurrency', str(concurrency), images]),
+    ('analyze-batch', lambda images, faceids, groupid, concurrency:
+        ['vision', 'analyze-batch', '--concurrency', str(concurrency), images]),
+    ('identify', lambda images, faceids, groupid, concurrency:
+        ['face', 'identify', '--persongroupid', groupid, '--faceids-file', faceids, '--concurrency', str(concurrency)]),
+    ('recognize', lambda images, faceids, groupid, concurrency:
+        ['face', 'recognize', '--persongroupid', groupid, '--concurrency', str(concurrency), '--linger', '0.05', images]),
+    ('sync', lambda images, faceids, groupid, concurrency:
+        ['persongroup', 'sync', '--full', '--concurrency', str(concurrency)]),
+])
+
+# run one command against the mock in a fresh process, measuring it
+def bench_run(server, url, workdir, args):
+    latencies = os.path.join(workdir, 'latencies')
+    if os.path.exists(latencies):
+        os.remove(latencies)
+    command = [sys.executable, os.path.abspath(__file__), '--oxford-url', url, '--rate', '0', '--no-cache',
+               '--output', 'ndjson'] + args
+    # a home of its own, with the benchmark's api keys, mirror and cache
+    env = dict(os.environ, HOME=workdir, OXFORD_BENCH_LATENCIES=latencies)
+    server.reset_count()
+    with open(os.devnull, 'w') as devnull:
+        started = time.time()
+        process = subprocess.Popen(command, stdout=devnull, stderr=devnull, env=env)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - started
+    process.returncode = status
+    requests_made = server.reset_count()
+    with open(latencies) as f:
+        times = sorted(float(line) for line in f if line.strip())
+    return {
+        'status' : os.WEXITSTATUS(status),
+        'requests' : requests_made,
+        'seconds' : round(seconds, 3),
+        'rps' : round(requests_made / seconds, 1),
+        'p50' : round(percentile(times, 50) * 1000, 1),
+        'p95' : round(percentile(times, 95) * 1000, 1),
+        'p99' : round(percentile(times, 99) * 1000, 1),
+        # kilobytes on Linux, bytes on OS X
+        'max_rss_mb' : round(usage.ru_maxrss / (1024.0 if sys.platform != 'darwin' else 1024.0 * 1024), 1),
+    }
+
+# make up the images, faceIds and PersonGroup a benchmark works on
+def bench_fixtures(server, workdir, images, image_size, persons):
+    directory = os.path.join(workdir, 'images')
+    os.makedirs(directory)
+    for i in range(images):
+        with open(os.path.join(directory, 'image%05d.jpg' % i), 'wb') as f:
+            f.write(os.urandom(image_size))
+    save_config(os.path.join(workdir, '.projectoxford.json'), { 'apikeys' : { 'face' : 'bench', 'vision' : 'bench' } })
+    faceids = os.path.join(workdir, 'faceids.txt')
+    with open(faceids, 'w') as f:
+        f.write(''.join('%s\n' % uuid.uuid4() for _ in range(images)))
+    groupid = 'bench'
+    server.handle('PUT', '/face/v0/persongroups/%s' % groupid, {}, { 'Ocp-Apim-Subscription-Key' : 'bench' },
+                  json.dumps({ 'name' : 'Benchmark' }))
+    for i in range(persons):
+        server.handle('POST', '/face/v0/persongroups/%s/persons' % groupid, {}, { 'Ocp-Apim-Subscription-Key' : 'bench' },
+                      json.dumps({ 'name' : 'Person %d' % i, 'faceIds' : [str(uuid.uuid4())] }))
+    server.reset_count()
+    return directory, faceids, groupid
+
+# the change from a baseline, as a percentage
+def change(value, baseline):
+    if not baseline:
+        return 'n/a'
+    return '%+.0f%%' % ((value - baseline) * 100.0 / baseline)
+
+@click.group(cls=LazyGroup)
+def bench():
+    pass
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--concurrency', default='1,4,16', help='Comma separated concurrency levels to run each command at.')
+@click.option('--images', default=200, help='Number of images, or faceIds, each run works on.')
+@click.option('--image-size', default=32 * 1024, help='Bytes in each image.')
+@click.option('--persons', default=50, help='Number of persons in the benchmark PersonGroup.')
+@click.option('--latency', default=0.02, help='Seconds each mock request takes.')
+@click.option('--jitter', default=0.005, help='Standard deviation of the mock latency, in seconds.')
+@click.option('--error-rate', default=0.0, help='Fraction of mock requests answered 500.')
+@click.option('--throttle-rate', default=0.0, help='Fraction of mock requests answered 429.')
+@click.option('--save', type=click.File('w'), default=None, help='Write the results as json lines to this file.')
+@click.option('--compare', type=click.File('r'), default=None, help='Show the change from the results saved in this file.')
+@click.argument('commands', nargs=-1, type=click.Choice(list(BENCHMARKS)))
+def bench_run_commands(concurrency, images, image_size, persons, latency, jitter, error_rate, throttle_rate, save, compare, commands):
+    """Measure requests/sec, latency and memory of commands against the mock api."""
+    try:
+        levels = [int(level) for level in concurrency.split(',')]
+    except ValueError:
+        raise click.BadParameter('--concurrency takes comma separated numbers, e.g. 1,4,16')
+    baseline = {}
+    if compare is not None:
+        for record in read_documents(compare):
+            baseline[(record['command'], record['concurrency'])] = record
+    server = MockOxford(latency, jitter, error_rate, throttle_rate, retry_after=1)
+    url = server.start()
+    workdir = tempfile.mkdtemp(prefix='oxford-bench-')
+    try:
+        fixtures = bench_fixtures(server, workdir, images, image_size, persons)
+        print '%-14s %5s %8s %8s %8s %8s %8s %8s %8s' % ('command', 'conc', 'requests', 'seconds', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'rss MB')
+        for command in commands or BENCHMARKS:
+            for level in levels:
+                record = bench_run(server, url, workdir, BENCHMARKS[command](*(fixtures + (level,))))
+                record.update(command=command, concurrency=level)
+                line = '%-14s %5d %8d %8.2f %8.1f %8.1f %8.1f %8.1f %8.1f' % (command, level, record['requests'], record['seconds'],
+                    record['rps'], record['p50'], record['p95'], record['p99'], record['max_rss_mb'])
+                if record['status']:
+                    line += '  (exit %d)' % record['status']
+                before = baseline.get((command, level))
+                if before:
+                    line += '  rps %s p95 %s rss %s' % (change(record['rps'], before['rps']), change(record['p95'], before['p95']),
+                                                       change(record['max_rss_mb'], before['max_rss_mb']))
+                print line
+                sys.stdout.flush()
+                if save is not None:
+                    save.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--budget', default=150.0, help='Milliseconds the median run may take before failing.')
+@click.option('--runs', default=10, type=click.IntRange(1, None), help='Number of fresh processes to time.')
+@click.argument('args', nargs=-1)
+def bench_startup(budget, runs, args):
+    """Time cold runs of a command line (after --), --help by default, failing over budget."""
+    command = [sys.executable, os.path.abspath(__file__)] + (list(args) or ['--help'])
+    # never hand the command to a daemon, that's not a cold run
+    env = dict(os.environ, OXFORD_NO_DAEMON='1')
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            started = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull, env=env)
+            times.append((time.time() - started) * 1000)
+    times.sort()
+    median = percentile(times, 50)
+    print 'oxford %s: min %.1fms median %.1fms max %.1fms over %d runs, budget %.1fms' % (
+        ' '.join(args) or '--help', times[0], median, times[-1], runs, budget)
+    if median > budget:
+        raise click.ClickException('Startup took %.1fms, over the %.1fms budget.' % (median, budget))
+
+#
+# Serve: a daemon on a unix socket that runs commands forwarded to it, keeping
+# its clients, rate limiters and caches warm between them
+#
+
+# the clients and caches a daemon keeps between commands, by their settings,
+# None when not serving
+warm = None
+warm_lock = threading.Lock()
+
+# the object made by factory for these settings, made once when serving
+def shared(kind, settings, factory):
+    if warm is None:
+        return factory()
+    key = (kind, settings)
+    with warm_lock:
+        if key not in warm:
+            warm[key] = factory()
+        return warm[key]
+
+# A command forwarded to the daemon: its command line, working directory and
+# environment, its streams back to the client, and the tracer and output
+# state every command would otherwise share
+class ForwardedCommand(object):
+
+    def __init__(self, request, stdin, stdout, stderr):
+        self.argv = request['argv']
+        self.cwd = request['cwd']
+        # the daemon's environment, but the client's OXFORD_ variables
+        self.env = dict((name, value) for name, value in os.environ.items() if not name.startswith('OXFORD_'))
+        self.env.update(request['env'])
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.tracer = None
+        self.output = { 'format' : 'json', 'csv' : None, 'dropped' : set() }
+
+# Stands in for one of the process's stdin, stdout, stderr, environ, tracer
+# or output state while serving, passing everything on to the forwarded
+# command's own on a thread working for one, and to the daemon's on others.
+# It has no __weakref__, so click can't keep a text wrapper of it for every
+# command to share.
+class CommandLocal(object):
+    __slots__ = ('name', 'default')
+
+    def __init__(self, name, default):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'default', default)
+
+    def target(self):
+        command = getattr(forwarded, 'command', None)
+        return getattr(command, self.name) if command else self.default
+
+    def __getattr__(self, attr):
+        return getattr(self.target(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.target(), attr, value)
+
+    def __nonzero__(self):
+        return bool(self.target())
+
+    def __iter__(self):
+        return iter(self.target())
+
+    def __contains__(self, key):
+        return key in self.target()
+
+    def __getitem__(self, key):
+        return self.target()[key]
+
+    def __setitem__(self, key, value):
+        self.target()[key] = value
+
+    def __delitem__(self, key):
+        del self.target()[key]
+
+# stdout or stderr of a forwarded command, sent back a write at a time
+class ForwardedStream(object):
+
+    def __init__(self, sock, channel, lock):
+        self.sock = sock
+        self.channel = channel
+        self.lock = lock
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if not data:
+            return
+        try:
+            with self.lock:
+                send_frame(self.sock, self.channel, data)
+        except socket.error:
+            # the client went away, as a closed pipe would
+            raise IOError(errno.EPIPE, 'Broken pipe')
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+# stdin of a forwarded command, fetched from the client as it's read, so a
+# command that never reads it doesn't wait for it
+class ForwardedStdin(object):
+
+    def __init__(self, sock, f, lock, tty):
+        self.sock = sock
+        self.f = f
+        self.lock = lock
+        self.tty = tty
+        self.buffer = ''
+        self.eof = False
+
+    # fetch another block, False at the end of input
+    def fill(self):
+        if self.eof:
+            return False
+        with self.lock:
+            send_frame(self.sock, 'i', '65536')
+        channel, data = recv_frame(self.f)
+        self.eof = not data
+        self.buffer += data
+        return bool(data)
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and self.fill():
+            pass
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while '\n' not in self.buffer and (size < 0 or len(self.buffer) < size) and self.fill():
+            pass
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def isatty(self):
+        return self.tty
+
+# A forwarded command: a json line with its argv, working directory, OXFORD_
+# environment and whether stdin is a terminal. The command runs with those
+# on this connection's thread, alongside any others the daemon is running.
+def handle_forwarded(handler):
+    request = json.loads(handler.rfile.readline())
+    if request.get('stop'):
+        send_frame(handler.connection, 'x', '0')
+        handler.server.shutdown()
+        return
+    lock = threading.Lock()
+    code = run_forwarded(ForwardedCommand(request,
+                                          ForwardedStdin(handler.connection, handler.rfile, lock, request['tty']),
+                                          ForwardedStream(handler.connection, 'o', lock),
+                                          ForwardedStream(handler.connection, 'e', lock)))
+    try:
+        send_frame(handler.connection, 'x', str(code))
+    except socket.error:
+        pass
+
+# a unix socket server running each forwarded command on a thread of its own
+def serve_server(path):
+
+    class Handler(SocketServer.StreamRequestHandler):
+
+        def handle(self):
+            handle_forwarded(self)
+
+    class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        # commands still running when the daemon stops go with it
+        daemon_threads = True
+
+    return Server(path, Handler)
+
+# the process-wide things a command uses, each forwarded command its own
+def serve_commands():
+    global tracer, OUTPUT
+    sys.stdin = CommandLocal('stdin', sys.stdin)
+    sys.stdout = CommandLocal('stdout', sys.stdout)
+    sys.stderr = CommandLocal('stderr', sys.stderr)
+    os.environ = CommandLocal('env', os.environ)
+    tracer = CommandLocal('tracer', tracer)
+    OUTPUT = CommandLocal('output', OUTPUT)
+
+# run a command as if from the client's shell, returning its exit code
+def run_forwarded(command):
+    forwarded.command = command
+    try:
+        oxford.main(args=command.argv, prog_name='oxford.py', auto_envvar_prefix='OXFORD')
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
     except Exception as e:
-        print e
+        # nobody to tell when the client went away
+        if not (isinstance(e, IOError) and e.errno == errno.EPIPE):
+            try:
+                traceback.print_exc()
+            except IOError:
+                pass
+        return 1
+    finally:
+        forwarded.command = None
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--socket', 'path', envvar='OXFORD_SOCKET', default=SOCKET_FILE, help='The unix socket to listen on.')
+@click.option('--stop', is_flag=True, help='Stop the daemon listening on the socket.')
+def serve(path, stop):
+    """Run commands forwarded from other invocations, keeping connections warm."""
+    global warm
+    if stop:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error:
+            raise click.UsageError('No daemon is listening on %s.' % path)
+        sock.sendall(json.dumps({ 'stop' : True }) + '\n')
+        recv_frame(sock.makefile('rb'))
+        return
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            raise click.UsageError('A daemon is already listening on %s.' % path)
+        except socket.error:
+            os.remove(path)
+        finally:
+            probe.close()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    warm = {}
+    umask = os.umask(0o077)
+    try:
+        server = serve_server(path)
+    finally:
+        os.umask(umask)
+    click.echo('Serving on %s, stop with oxford serve --stop' % path, err=True)
+    serve_commands()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
 
 #
 # Wiring up subcommands
 #
 
 # Face
-oxford.add_command(face)
-face.add_command(face_api_key, name="save-api-key")
-face.add_command(detect)
-face.add_command(find_similar)
-face.add_command(find_groups)
-face.add_command(identify)
+oxford.add_lazy_command("face", "face")
+face.add_lazy_command("save-api-key", "face_api_key")
+face.add_lazy_command("detect", "detect")
+face.add_lazy_command("detect-batch", "detect_batch")
+face.add_lazy_command("find_similar", "find_similar")
+face.add_lazy_command("find_groups", "find_groups")
+face.add_lazy_command("identify", "identify")
+face.add_lazy_command("verify", "verify")
+face.add_lazy_command("recognize", "recognize")
 
 # PersonGroup
-oxford.add_command(persongroup)
-persongroup.add_command(create_persongroup, name="create")
-persongroup.add_command(retrieve_all_persongroups, name="retrieve_all")
-persongroup.add_command(retrieve_persongroup,name="retrieve")
-persongroup.add_command(training_status)
-persongroup.add_command(train_persongroup, name="train")
-persongroup.add_command(update_persongroup, name="update")
-persongroup.add_command(delete_persongroup, name="delete")
-persongroup.add_command(list_people_in_persongroup, name="list_people")
+oxford.add_lazy_command("persongroup", "persongroup")
+persongroup.add_lazy_command("create", "create_persongroup")
+persongroup.add_lazy_command("retrieve_all", "retrieve_all_persongroups")
+persongroup.add_lazy_command("retrieve", "retrieve_persongroup")
+persongroup.add_lazy_command("training_status", "training_status")
+persongroup.add_lazy_command("train", "train_persongroup")
+persongroup.add_lazy_command("wait", "wait_persongroup")
+persongroup.add_lazy_command("update", "update_persongroup")
+persongroup.add_lazy_command("delete", "delete_persongroup")
+persongroup.add_lazy_command("list_people", "list_people_in_persongroup")
+persongroup.add_lazy_command("import", "import_persongroup")
+persongroup.add_lazy_command("sync", "sync_persongroups")
 
 # Person
-oxford.add_command(person)
-person.add_command(create_person, name="create")
-person.add_command(retrieve_person, name="retrieve")
-person.add_command(update_person, name="update")
-person.add_command(delete_person, name="delete")
+oxford.add_lazy_command("person", "person")
+person.add_lazy_command("create", "create_person")
+person.add_lazy_command("retrieve", "retrieve_person")
+person.add_lazy_command("update", "update_person")
+person.add_lazy_command("delete", "delete_person")
 
 # PersonFace
-oxford.add_command(personface)
-personface.add_command(add_personface, name="add")
-personface.add_command(retrieve_personface, name="retrieve")
-personface.add_command(update_personface, name="update")
-personface.add_command(delete_personface, name="delete")
+oxford.add_lazy_command("personface", "personface")
+personface.add_lazy_command("add", "add_personface")
+personface.add_lazy_command("retrieve", "retrieve_personface")
+personface.add_lazy_command("update", "update_personface")
+personface.add_lazy_command("delete", "delete_personface")
+personface.add_lazy_command("owner", "personface_owner")
 
 # Vision
-oxford.add_command(vision)
-vision.add_command(vision_api_key, name="save-api-key")
-vision.add_command(analyze_image, name="analyze")
-vision.add_command(thumbnail)
-vision.add_command(ocr)
+oxford.add_lazy_command("vision", "vision")
+vision.add_lazy_command("save-api-key", "vision_api_key")
+vision.add_lazy_command("analyze", "analyze_image")
+vision.add_lazy_command("analyze-batch", "analyze_batch")
+vision.add_lazy_command("thumbnail", "thumbnail")
+vision.add_lazy_command("thumbnail-batch", "thumbnail_batch")
+vision.add_lazy_command("ocr", "ocr")
+vision.add_lazy_command("ocr-batch", "ocr_batch")
+vision.add_lazy_command("ocr-search", "ocr_search")
+
+# Cache
+oxford.add_lazy_command("cache", "cache")
+cache.add_lazy_command("stats", "cache_stats")
+cache.add_lazy_command("purge", "cache_purge")
+
+# Reports
+oxford.add_lazy_command("report", "report")
+
+# Mock api and benchmarks
+oxford.add_lazy_command("mock", "mock")
+oxford.add_lazy_command("bench", "bench")
+bench.add_lazy_command("run", "bench_run_commands")
+bench.add_lazy_command("startup", "bench_startup")
+
+# Daemon
+oxford.add_lazy_command("serve", "serve")
 
 if __name__ == '__main__':
-    oxford(auto_envvar_prefix='OXFORD')
\ No newline at end of file
+    oxford(auto_envvar_prefix='OXFORD')